@@ -1,6 +1,7 @@
 from diagonal import DiagonalAlgorithm
 from horizontal import HorizontalAlgorithm
 from horizontal_bottom import HorizontalBottomAlgorithm
+from maxrects import MaxRectsAlgorithm
 from square import SquareAlgorithm
 from vertical import VerticalAlgorithm
 from vertical_right import VerticalRightAlgorithm
@@ -8,6 +9,7 @@ from vertical_right import VerticalRightAlgorithm
 algorithms = {'diagonal': DiagonalAlgorithm,
               'horizontal': HorizontalAlgorithm,
               'horizontal-bottom': HorizontalBottomAlgorithm,
+              'maxrects': MaxRectsAlgorithm,
               'square': SquareAlgorithm,
               'vertical': VerticalAlgorithm,
               'vertical-right': VerticalRightAlgorithm}
@@ -1,9 +1,10 @@
 class DiagonalAlgorithm(object):
 
     def process(self, sprite):
+        layout = sprite.layout
         x = y = 0
-        for image in sprite.images:
-            image.x = x
-            image.y = y
-            x += image.absolute_width
-            y += image.absolute_height
+        for row in xrange(len(layout)):
+            layout.x[row] = x
+            layout.y[row] = y
+            x += layout.absolute_width[row]
+            y += layout.absolute_height[row]
@@ -1,8 +1,9 @@
 class HorizontalAlgorithm(object):
 
     def process(self, sprite):
+        layout = sprite.layout
         x = 0
-        for image in sprite.images:
-            image.y = 0
-            image.x = x
-            x += image.absolute_width
+        for row in xrange(len(layout)):
+            layout.y[row] = 0
+            layout.x[row] = x
+            x += layout.absolute_width[row]
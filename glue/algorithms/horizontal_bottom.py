@@ -1,9 +1,10 @@
 class HorizontalBottomAlgorithm(object):
 
     def process(self, sprite):
-        max_height = max([i.height for i in sprite.images])
+        layout = sprite.layout
+        max_height = max(layout.height)
         x = 0
-        for image in sprite.images:
-            image.y = max_height - image.height
-            image.x = x
-            x += image.absolute_width
+        for row in xrange(len(layout)):
+            layout.y[row] = max_height - layout.height[row]
+            layout.x[row] = x
+            x += layout.absolute_width[row]
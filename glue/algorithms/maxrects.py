@@ -0,0 +1,355 @@
+import math
+from array import array
+from sys import maxint
+from bisect import bisect_left, bisect_right, insort
+
+
+class RectangleIndex(object):
+    """Rectangles indexed by an integer key (like one of their sides).
+
+    Keys are the leaves of a tree where every node stores the largest width
+    and height of the rectangles of its range of keys, so walking the
+    rectangles by key skips every range where an image can't fit.
+    """
+
+    def __init__(self, size):
+        """Index constructor.
+
+        :param size: Number of keys of the index.
+        """
+        leaves = 1
+        while leaves < size:
+            leaves *= 2
+        self.leaves = leaves
+        self.max_width = array('l', [-1]) * (2 * leaves)
+        self.max_height = array('l', [-1]) * (2 * leaves)
+        self.buckets = {}
+
+    def add(self, key, rect_id, rect):
+        self.buckets.setdefault(key, {})[rect_id] = rect
+        node = key + self.leaves
+        if rect[2] > self.max_width[node] or rect[3] > self.max_height[node]:
+            self.max_width[node] = max(self.max_width[node], rect[2])
+            self.max_height[node] = max(self.max_height[node], rect[3])
+            self._update(node >> 1)
+
+    def remove(self, key, rect_id, rect):
+        bucket = self.buckets[key]
+        del bucket[rect_id]
+        node = key + self.leaves
+        if rect[2] == self.max_width[node] or rect[3] == self.max_height[node]:
+            self.max_width[node] = max([r[2] for r in bucket.itervalues()] or [-1])
+            self.max_height[node] = max([r[3] for r in bucket.itervalues()] or [-1])
+            self._update(node >> 1)
+
+    def _update(self, node):
+        """Update the largest sizes of ``node`` and its ancestors after one
+        of their leaves changed."""
+        max_width, max_height = self.max_width, self.max_height
+        while node:
+            left = node * 2
+            width, other = max_width[left], max_width[left + 1]
+            if other > width:
+                width = other
+            height, other = max_height[left], max_height[left + 1]
+            if other > height:
+                height = other
+            if max_width[node] == width and max_height[node] == height:
+                break
+            max_width[node], max_height[node] = width, height
+            node >>= 1
+
+    def walk(self, key, width, height):
+        """Yield the key, id and rectangle of every rectangle with a key
+        equal or greater than ``key`` where an image of this size fits, by
+        increasing key."""
+        max_width, max_height, leaves = self.max_width, self.max_height, self.leaves
+        node = key + leaves
+        while True:
+            if max_width[node] >= width and max_height[node] >= height:
+                if node < leaves:
+                    node *= 2
+                    continue
+                key = node - leaves
+                for rect_id, rect in self.buckets[key].items():
+                    if rect[2] >= width and rect[3] >= height:
+                        yield key, rect_id, rect
+
+            # Move to the next range of keys.
+            while node & 1:
+                node >>= 1
+            if not node:
+                return
+            node += 1
+
+
+class FreeRectangles(object):
+    """Free rectangles of a MaxRects bin.
+
+    Rectangles are indexed by the vertical stripes of the bin they cross,
+    so splitting and pruning them only need to look at the rectangles
+    around the area being changed. They are also indexed by width, by
+    height and by horizontal bands as tall as the tallest image (see
+    :class:`RectangleIndex`), so finding where an image goes only looks at
+    rectangles where it fits and stops as soon as no other rectangle can be
+    a better choice. Widths and heights larger than the largest image are
+    all the same for the indexes.
+
+    Rectangles narrower than ``min_width`` or shorter than ``min_height``
+    (the smallest images left to place) can't be used anymore, so they are
+    dropped instead of being indexed.
+    """
+
+    def __init__(self, width, height, stripe_width, max_width, max_height, by_position=False):
+        """Free rectangles constructor.
+
+        :param width: Width of the bin.
+        :param height: Height of the bin.
+        :param stripe_width: Width of the vertical stripes of the bin.
+        :param max_width: Width of the widest image.
+        :param max_height: Height of the tallest image.
+        :param by_position: Index the rectangles by position (used by
+                            :meth:`lowest`) instead of by size (used by
+                            :meth:`best`).
+        """
+        self.stripe_width = stripe_width
+        self.max_width, self.max_height = max_width, max_height
+        self.rects = {}
+        self.stripes = {}
+        if by_position:
+            self.by_top = RectangleIndex(height // max_height + 1)
+            self.by_width = self.by_height = None
+        else:
+            self.by_width = RectangleIndex(max_width + 1)
+            self.by_height = RectangleIndex(max_height + 1)
+            self.by_top = None
+        self.min_width = self.min_height = 0
+        self.next_id = 0
+        self.add((0, 0, width, height))
+
+    def _stripes(self, x, width):
+        return xrange(x // self.stripe_width, (x + width - 1) // self.stripe_width + 1)
+
+    def add(self, rect):
+        if self._is_dead(rect):
+            return None
+        rect_id = self.next_id
+        self.next_id += 1
+        self.rects[rect_id] = rect
+        for stripe in self._stripes(rect[0], rect[2]):
+            insort(self.stripes.setdefault(stripe, []), (rect[1] + rect[3], rect[1], rect_id))
+        if self.by_top is None:
+            self.by_width.add(min(rect[2], self.max_width), rect_id, rect)
+            self.by_height.add(min(rect[3], self.max_height), rect_id, rect)
+        else:
+            self.by_top.add(rect[1] // self.max_height, rect_id, rect)
+        return rect_id
+
+    def remove(self, rect_id):
+        rect = self.rects.pop(rect_id)
+        for stripe in self._stripes(rect[0], rect[2]):
+            entries = self.stripes[stripe]
+            del entries[bisect_left(entries, (rect[1] + rect[3], rect[1], rect_id))]
+        if self.by_top is None:
+            self.by_width.remove(min(rect[2], self.max_width), rect_id, rect)
+            self.by_height.remove(min(rect[3], self.max_height), rect_id, rect)
+        else:
+            self.by_top.remove(rect[1] // self.max_height, rect_id, rect)
+
+    def _is_dead(self, rect):
+        return rect[2] < self.min_width or rect[3] < self.min_height
+
+    def best(self, width, height, score, bound):
+        """Return the free rectangle with the lowest ``score`` where an
+        image of this size fits (the top-most and then left-most one if
+        several have the same score) or ``None`` if there is none.
+
+        Rectangles are visited by increasing leftover width and height at
+        the same time, so every rectangle not visited yet has a score of at
+        least ``bound(leftover_w, leftover_h, width, height)`` and the
+        search stops once that is worse than the best score found.
+        """
+        by_width = self.by_width.walk(width, width, height)
+        by_height = self.by_height.walk(height, width, height)
+        next_w, next_h = next(by_width, None), next(by_height, None)
+        best = best_score = None
+        # Every rectangle where the image fits is in both walks, so once one
+        # of them is over all of them were visited.
+        while next_w is not None and next_h is not None:
+            leftover_w, leftover_h = next_w[0] - width, next_h[0] - height
+            if best is not None and bound(leftover_w, leftover_h, width, height) > best_score[0]:
+                break
+
+            if leftover_w * height <= leftover_h * width:
+                rect = next_w[2]
+                next_w = next(by_width, None)
+            else:
+                rect = next_h[2]
+                next_h = next(by_height, None)
+
+            rect_score = score(rect, width, height)
+            if best is None or rect_score < best_score or \
+                    (rect_score == best_score and rect[1::-1] < best[1::-1]):
+                best, best_score = rect, rect_score
+
+        return best
+
+    def lowest(self, width, height):
+        """Return the top-most (and then left-most) free rectangle where an
+        image of this size fits or ``None`` if there is none."""
+        best = best_key = None
+        for key, _, rect in self.by_top.walk(0, width, height):
+            if best is not None and key != best_key:
+                break
+            if best is None or rect[1::-1] < best[1::-1]:
+                best, best_key = rect, key
+        return best
+
+    def overlapping(self, x, y, width, height):
+        """Return the ids of the rectangles overlapping this area."""
+        right, bottom = x + width, y + height
+        ids = set()
+        for stripe in self._stripes(x, width):
+            entries = self.stripes.get(stripe, ())
+            ids.update(rect_id for _, _, rect_id in entries[bisect_right(entries, (y, maxint)):])
+
+        overlapping = []
+        for rect_id in ids:
+            rx, ry, rw, rh = self.rects[rect_id]
+            if rx < right and x < rx + rw and ry < bottom:
+                overlapping.append(rect_id)
+        return overlapping
+
+    def containing(self, rect):
+        """Return ``True`` if any free rectangle contains ``rect``. Any of
+        them also contains its top-left corner, so only the ones in its
+        stripe starting above it and reaching as low as it does are
+        checked."""
+        rects, y = self.rects, rect[1]
+        entries = self.stripes.get(rect[0] // self.stripe_width, ())
+        i, count = bisect_left(entries, (y + rect[3],)), len(entries)
+        while i < count:
+            bottom, top, rect_id = entries[i]
+            if top > y:
+                # Skip the rest of the rectangles with this bottom.
+                i = bisect_left(entries, (bottom + 1,), i)
+            elif contains(rects[rect_id], rect):
+                return True
+            else:
+                i += 1
+        return False
+
+    def place(self, x, y, width, height):
+        """Remove this area from the free rectangles splitting every free
+        rectangle it overlaps and removing the redundant ones."""
+        right, bottom = x + width, y + height
+        created = []
+        for rect_id in self.overlapping(x, y, width, height):
+            fx, fy, fw, fh = self.rects[rect_id]
+            self.remove(rect_id)
+            if x > fx:
+                created.append((fx, fy, x - fx, fh))
+            if right < fx + fw:
+                created.append((right, fy, fx + fw - right, fh))
+            if y > fy:
+                created.append((fx, fy, fw, y - fy))
+            if bottom < fy + fh:
+                created.append((fx, bottom, fw, fy + fh - bottom))
+
+        # Drop new rectangles contained in other free rectangles. No free
+        # rectangle contains another one, so none of the old ones can be
+        # inside a new one (which is inside the one it was split from).
+        for i, rect in enumerate(created):
+            if self._is_dead(rect):
+                continue
+            contained = False
+            for j, other in enumerate(created):
+                if i != j and contains(other, rect) and (other != rect or j < i):
+                    contained = True
+                    break
+            if contained:
+                continue
+
+            if not self.containing(rect):
+                self.add(rect)
+
+
+def contains(a, b):
+    """Return ``True`` if the rectangle ``a`` contains ``b``."""
+    return (a[0] <= b[0] and a[1] <= b[1] and
+            b[0] + b[2] <= a[0] + a[2] and b[1] + b[3] <= a[1] + a[3])
+
+
+def best_short_side_fit(rect, width, height):
+    leftover_w, leftover_h = rect[2] - width, rect[3] - height
+    return min(leftover_w, leftover_h), max(leftover_w, leftover_h)
+
+
+def best_area_fit(rect, width, height):
+    leftover_w, leftover_h = rect[2] - width, rect[3] - height
+    return rect[2] * rect[3] - width * height, min(leftover_w, leftover_h)
+
+
+def best_short_side_bound(leftover_w, leftover_h, width, height):
+    return min(leftover_w, leftover_h)
+
+
+def best_area_bound(leftover_w, leftover_h, width, height):
+    return leftover_w * height + leftover_h * width + leftover_w * leftover_h
+
+
+class MaxRectsAlgorithm(object):
+    """Pack the images using the MaxRects algorithm described in `A
+    Thousand Ways to Pack the Bin <http://clb.demon.fi/files/RectangleBinPack.pdf>`_
+    by Jukka Jylanki.
+
+    The bin is as wide as the square root of the area of all the images
+    (or the widest image) and tall enough to contain all of them, so the
+    resulting sprite is as square as possible.
+    """
+
+    # Score and lower bound of the score of every heuristic. Bottom-left
+    # picks the top-most rectangle, so it only needs the position index.
+    heuristics = {'best-short-side': (best_short_side_fit, best_short_side_bound),
+                  'best-area': (best_area_fit, best_area_bound),
+                  'bottom-left': (None, None)}
+
+    def process(self, sprite):
+        layout = sprite.layout
+        widths, heights = layout.absolute_width, layout.absolute_height
+        score, bound = self.heuristics[sprite.config.get('maxrects_heuristic') or 'best-short-side']
+
+        rows = len(layout)
+        area = sum(w * h for w, h in zip(widths, heights))
+        width = max(max(widths), int(math.ceil(math.sqrt(area))), 1)
+        height = max(sum(heights), 1)
+        stripe_width = max(width // 8, 1)
+
+        # Smallest width and height of the images from every row onwards.
+        min_widths, min_heights = [0] * rows, [0] * rows
+        min_w = min_h = 0
+        for row in reversed(xrange(rows)):
+            w, h = widths[row], heights[row]
+            if w and h:
+                min_w, min_h = min(min_w or w, w), min(min_h or h, h)
+            min_widths[row], min_heights[row] = min_w, min_h
+
+        free = FreeRectangles(width, height, stripe_width, max(max(widths), 1), max(max(heights), 1),
+                              by_position=score is None)
+
+        for row in xrange(rows):
+            w, h = widths[row], heights[row]
+            if not w or not h:
+                layout.x[row] = layout.y[row] = 0
+                continue
+
+            free.min_width, free.min_height = min_widths[row], min_heights[row]
+            if score is None:
+                best = free.lowest(w, h)
+            else:
+                best = free.best(w, h, score, bound)
+
+            x, y = best[0], best[1]
+            free.place(x, y, w, h)
+            layout.x[row] = x
+            layout.y[row] = y
@@ -1,39 +1,99 @@
-import copy
+from array import array
 
 
-class SquareAlgorithmNode(object):
+class SquareAlgorithmNodes(object):
+    """Binary tree used by the square algorithm.
 
-    def __init__(self, x=0, y=0, width=0, height=0, used=False,
-                 down=None, right=None):
-        """Node constructor.
+    Nodes are rows of a pool of preallocated arrays instead of objects, and
+    they are referenced by index (``-1`` meaning no node). Every node also
+    stores the largest width, height and short side of the unused nodes of
+    its subtree, so searching the tree skips all the subtrees where an image
+    can't fit. Unused nodes without area (which splitting leaves all over
+    the tree) are left out of those sizes, as only images without area fit
+    in them.
+    """
 
-        :param x: X coordinate.
-        :param y: Y coordinate.
-        :param width: Image width.
-        :param height: Image height.
-        :param used: Flag to determine if the node is used.
-        :param down: Down :class:`~Node`.
-        :param right Right :class:`~Node`.
+    def __init__(self, size, width, height):
+        """Nodes constructor.
+
+        :param size: Maximum number of nodes of the tree.
+        :param width: Width of the root node.
+        :param height: Height of the root node.
         """
-        self.x = x
-        self.y = y
-        self.width = width
-        self.height = height
-        self.used = used
-        self.right = right
-        self.down = down
-
-    def find(self, node, width, height):
+        self.x = array('l', [0]) * size
+        self.y = array('l', [0]) * size
+        self.width = array('l', [0]) * size
+        self.height = array('l', [0]) * size
+        self.used = array('b', [0]) * size
+        self.right = array('l', [-1]) * size
+        self.down = array('l', [-1]) * size
+        self.parent = array('l', [-1]) * size
+        self.free_width = array('l', [0]) * size
+        self.free_height = array('l', [0]) * size
+        self.free_side = array('l', [0]) * size
+        self.count = 0
+        self.root = self.add(0, 0, width, height)
+
+    def add(self, x, y, width, height):
+        """Add an unused node and return its index."""
+        node = self.count
+        self.count += 1
+        self.x[node], self.y[node] = x, y
+        self.width[node], self.height[node] = width, height
+        if width and height:
+            self.free_width[node], self.free_height[node] = width, height
+            self.free_side[node] = min(width, height)
+        else:
+            self.free_width[node] = self.free_height[node] = self.free_side[node] = -1
+        return node
+
+    def link(self, node, right, down):
+        """Mark ``node`` as used with these children."""
+        self.used[node] = 1
+        self.right[node], self.down[node] = right, down
+        self.parent[right] = self.parent[down] = node
+        self.update(node)
+
+    def update(self, node):
+        """Update the largest unused sizes of ``node`` and its ancestors
+        after its children changed."""
+        free_width, free_height, free_side = self.free_width, self.free_height, self.free_side
+        while node != -1:
+            right, down = self.right[node], self.down[node]
+            width = max(free_width[right], free_width[down])
+            height = max(free_height[right], free_height[down])
+            side = max(free_side[right], free_side[down])
+            if free_width[node] == width and free_height[node] == height and free_side[node] == side:
+                break
+            free_width[node], free_height[node], free_side[node] = width, height, side
+            node = self.parent[node]
+
+    def find(self, width, height):
         """Find a node to allocate this image size (width, height).
 
-        :param node: Node to search in.
-        :param width: Pixels to grow down (width).
-        :param height: Pixels to grow down (height).
+        The tree is searched in pre-order visiting the right child of every
+        node before the down one.
+
+        :param width: Image width.
+        :param height: Image height.
         """
-        if node.used:
-            return self.find(node.right, width, height) or self.find(node.down, width, height)
-        elif node.width >= width and node.height >= height:
-            return node
+        side = min(width, height)
+        if side:
+            free_width, free_height, free_side = self.free_width, self.free_height, self.free_side
+        else:
+            # Images without area also fit in nodes without area, which
+            # are only bounded by the size of their ancestors.
+            free_width, free_height, free_side = self.width, self.height, self.width
+        used, right, down = self.used, self.right, self.down
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not used[node]:
+                if self.width[node] >= width and self.height[node] >= height:
+                    return node
+            elif free_width[node] >= width and free_height[node] >= height and free_side[node] >= side:
+                stack.append(down[node])
+                stack.append(right[node])
         return None
 
     def grow(self, width, height):
@@ -42,11 +102,12 @@ class SquareAlgorithmNode(object):
         :param width: Pixels to grow down (width).
         :param height: Pixels to grow down (height).
         """
-        can_grow_d = width <= self.width
-        can_grow_r = height <= self.height
+        root_width, root_height = self.width[self.root], self.height[self.root]
+        can_grow_d = width <= root_width
+        can_grow_r = height <= root_height
 
-        should_grow_r = can_grow_r and self.height >= (self.width + width)
-        should_grow_d = can_grow_d and self.width >= (self.height + height)
+        should_grow_r = can_grow_r and root_height >= (root_width + width)
+        should_grow_d = can_grow_d and root_width >= (root_height + height)
 
         if should_grow_r:
             return self.grow_right(width, height)
@@ -60,46 +121,32 @@ class SquareAlgorithmNode(object):
         return None
 
     def grow_right(self, width, height):
-        """Grow the canvas to the right.
+        """Grow the canvas to the right. The image is allocated in the new
+        area, as it didn't fit anywhere else.
 
         :param width: Pixels to grow down (width).
         :param height: Pixels to grow down (height).
         """
-        old_self = copy.copy(self)
-        self.used = True
-        self.x = self.y = 0
-        self.width += width
-        self.down = old_self
-        self.right = SquareAlgorithmNode(x=old_self.width,
-                                         y=0,
-                                         width=width,
-                                         height=self.height)
-
-        node = self.find(self, width, height)
-        if node:
-            return self.split(node, width, height)
-        return None
+        old_root = self.root
+        old_width, old_height = self.width[old_root], self.height[old_root]
+        self.root = self.add(0, 0, old_width + width, old_height)
+        node = self.add(old_width, 0, width, old_height)
+        self.link(self.root, right=node, down=old_root)
+        return self.split(node, width, height)
 
     def grow_down(self, width, height):
-        """Grow the canvas down.
+        """Grow the canvas down. The image is allocated in the new area, as
+        it didn't fit anywhere else.
 
         :param width: Pixels to grow down (width).
         :param height: Pixels to grow down (height).
         """
-        old_self = copy.copy(self)
-        self.used = True
-        self.x = self.y = 0
-        self.height += height
-        self.right = old_self
-        self.down = SquareAlgorithmNode(x=0,
-                                        y=old_self.height,
-                                        width=self.width,
-                                        height=height)
-
-        node = self.find(self, width, height)
-        if node:
-            return self.split(node, width, height)
-        return None
+        old_root = self.root
+        old_width, old_height = self.width[old_root], self.height[old_root]
+        self.root = self.add(0, 0, old_width, old_height + height)
+        node = self.add(0, old_height, old_width, height)
+        self.link(self.root, right=old_root, down=node)
+        return self.split(node, width, height)
 
     def split(self, node, width, height):
         """Split the node to allocate a new one of this size.
@@ -108,15 +155,11 @@ class SquareAlgorithmNode(object):
         :param width: New node width.
         :param height: New node height.
         """
-        node.used = True
-        node.down = SquareAlgorithmNode(x=node.x,
-                                        y=node.y + height,
-                                        width=node.width,
-                                        height=node.height - height)
-        node.right = SquareAlgorithmNode(x=node.x + width,
-                                         y=node.y,
-                                         width=node.width - width,
-                                         height=height)
+        x, y = self.x[node], self.y[node]
+        node_width, node_height = self.width[node], self.height[node]
+        down = self.add(x, y + height, node_width, node_height - height)
+        right = self.add(x + width, y, node_width - width, height)
+        self.link(node, right=right, down=down)
         return node
 
 
@@ -124,16 +167,21 @@ class SquareAlgorithm(object):
 
     def process(self, sprite):
 
-        root = SquareAlgorithmNode(width=sprite.images[0].absolute_width,
-                                   height=sprite.images[0].absolute_height)
+        layout = sprite.layout
+        # Every image splits a node in two and growing the canvas adds two
+        # more nodes, so the tree never has more than 4 nodes per image.
+        nodes = SquareAlgorithmNodes(size=len(layout) * 4 + 1,
+                                     width=layout.absolute_width[0],
+                                     height=layout.absolute_height[0])
 
         # Loot all over the images creating a binary tree
-        for image in sprite.images:
-            node = root.find(root, image.absolute_width, image.absolute_height)
-            if node:  # Use this node
-                node = root.split(node, image.absolute_width, image.absolute_height)
+        for row in xrange(len(layout)):
+            width, height = layout.absolute_width[row], layout.absolute_height[row]
+            node = nodes.find(width, height)
+            if node is not None:  # Use this node
+                node = nodes.split(node, width, height)
             else:  # Grow the canvas
-                node = root.grow(image.absolute_width, image.absolute_height)
+                node = nodes.grow(width, height)
 
-            image.x = node.x
-            image.y = node.y
+            layout.x[row] = nodes.x[node]
+            layout.y[row] = nodes.y[node]
@@ -1,8 +1,9 @@
 class VerticalAlgorithm(object):
 
     def process(self, sprite):
+        layout = sprite.layout
         y = 0
-        for image in sprite.images:
-            image.x = 0
-            image.y = y
-            y += image.absolute_height
+        for row in xrange(len(layout)):
+            layout.x[row] = 0
+            layout.y[row] = y
+            y += layout.absolute_height[row]
@@ -1,9 +1,10 @@
 class VerticalRightAlgorithm(object):
 
     def process(self, sprite):
-        max_width = max([i.width for i in sprite.images])
+        layout = sprite.layout
+        max_width = max(layout.width)
         y = 0
-        for image in sprite.images:
-            image.x = max_width - image.width
-            image.y = y
-            y += image.absolute_height
+        for row in xrange(len(layout)):
+            layout.x[row] = max_width - layout.width[row]
+            layout.y[row] = y
+            y += layout.absolute_height[row]
@@ -6,12 +6,19 @@ import argparse
 from PIL import Image as PImage
 
 from glue.formats import formats
-from glue.helpers import redirect_stdout
+from glue.helpers import redirect_stdout, common_directory
 from glue import exceptions
 from glue import managers
 from glue import __version__
 
 
+def read_file_list(stream):
+    """Return the absolute path of every file listed in ``stream``, one per
+    line. Empty lines are ignored."""
+    lines = [line.strip() for line in stream.read().decode('utf-8').splitlines()]
+    return [os.path.abspath(line) for line in lines if line]
+
+
 def main(argv=None):
 
     argv = (argv or sys.argv)[1:]
@@ -30,6 +37,15 @@ def main(argv=None):
                         default=os.environ.get('GLUE_OUTPUT', None),
                         help="Output path")
 
+    parser.add_argument("--file-list",
+                        dest="file_list",
+                        type=unicode,
+                        default=os.environ.get('GLUE_FILE_LIST', None),
+                        metavar='FILE',
+                        help=("Read the source images from this file (one "
+                              "path per line, '-' for stdin) instead of "
+                              "walking the source directory"))
+
     parser.add_argument("-q", "--quiet",
                         dest="quiet",
                         action='store_true',
@@ -49,6 +65,23 @@ def main(argv=None):
                         default=os.environ.get('GLUE_FOLLOW_LINKS', False),
                         help="Follow symbolic links.")
 
+    parser.add_argument("--include",
+                        dest="include",
+                        type=unicode,
+                        default=os.environ.get('GLUE_INCLUDE', None),
+                        metavar='PATTERNS',
+                        help=("Only add the images matching any of these "
+                              "comma-separated glob patterns"))
+
+    parser.add_argument("--exclude",
+                        dest="exclude",
+                        type=unicode,
+                        default=os.environ.get('GLUE_EXCLUDE', None),
+                        metavar='PATTERNS',
+                        help=("Ignore the images and skip the directories "
+                              "matching any of these comma-separated glob "
+                              "patterns"))
+
     parser.add_argument("-f", "--force",
                         dest="force",
                         action='store_true',
@@ -70,6 +103,31 @@ def main(argv=None):
                         default=os.environ.get('GLUE_PROJECT', False),
                         help="Generate sprites for multiple folders")
 
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int,
+                        default=os.environ.get('GLUE_JOBS', 1),
+                        metavar='N',
+                        help=("Number of processes used to decode the source "
+                              "images or, using --project, to build the "
+                              "sprites (default: 1)"))
+
+    parser.add_argument("--max-memory",
+                        dest="max_memory",
+                        type=int,
+                        default=os.environ.get('GLUE_MAX_MEMORY', None),
+                        metavar='MB',
+                        help=("Estimated memory (in MB) the sprites built at "
+                              "the same time using --jobs can use"))
+
+    parser.add_argument("--cache",
+                        dest="cache_dir",
+                        type=unicode,
+                        default=os.environ.get('GLUE_CACHE', None),
+                        metavar='DIR',
+                        help=("Cache the decoded source images in this "
+                              "directory to speed up the next builds"))
+
     parser.add_argument("-v", "--version",
                         action="version",
                         version='%(prog)s ' + __version__,
@@ -84,10 +142,20 @@ def main(argv=None):
                        default=os.environ.get('GLUE_ALGORITHM', 'square'),
                        choices=['square', 'vertical', 'horizontal',
                                 'vertical-right', 'horizontal-bottom',
-                                'diagonal'],
+                                'diagonal', 'maxrects'],
                        help=("Allocation algorithm: square, vertical, "
                              "horizontal, vertical-right, horizontal-bottom, "
-                             "diagonal. (default: square)"))
+                             "diagonal, maxrects. (default: square)"))
+
+    group.add_argument("--maxrects-heuristic",
+                       dest="maxrects_heuristic",
+                       metavar='NAME',
+                       type=unicode,
+                       default=os.environ.get('GLUE_MAXRECTS_HEURISTIC', 'best-short-side'),
+                       choices=['best-short-side', 'best-area', 'bottom-left'],
+                       help=("Free rectangle choice heuristic of the maxrects "
+                             "algorithm: best-short-side, best-area or "
+                             "bottom-left (default: best-short-side)"))
 
     group.add_argument("--ordering",
                        dest="algorithm_ordering",
@@ -151,9 +219,17 @@ def main(argv=None):
             parser.error(("{0} argument is deprectated "
                           "since v0.3").format(deprecated_arguments[argument]))
 
+    if options.jobs < 1:
+        parser.error("--jobs must be greater than 0.")
+
+    if options.max_memory is not None and options.max_memory < 1:
+        parser.error("--max-memory must be greater than 0.")
+
     extra = 0
-    # Get the source from the source option or the first positional argument
-    if not options.source and args:
+    # Get the source from the source option or the first positional argument.
+    # If the source images come from a file list the source is optional, so
+    # a single positional argument is the output.
+    if not options.source and args and not (options.file_list and len(args) == 1):
         options.source = args[0]
         extra += 1
 
@@ -161,6 +237,29 @@ def main(argv=None):
     if not options.output and args[extra:]:
         options.output = args[extra]
 
+    options.files = None
+    if options.file_list:
+        if options.project:
+            parser.error("You can't use --file-list with --project.")
+
+        try:
+            if options.file_list == '-':
+                options.files = read_file_list(sys.stdin)
+            else:
+                with open(options.file_list) as f:
+                    options.files = read_file_list(f)
+        except IOError:
+            parser.error("File not found: '{0}'".format(options.file_list))
+
+        for path in options.files:
+            if not os.path.isfile(path):
+                parser.error("File not found: '{0}'".format(path))
+
+        # Without an explicit source, the sprite folder is the deepest
+        # directory containing all the listed files.
+        if options.source is None and options.files:
+            options.source = common_directory(options.files)
+
     # Check if source is available
     if options.source is None:
         parser.error(("You must provide the folder containing the sprites "
@@ -171,6 +270,8 @@ def main(argv=None):
         parser.error("Directory not found: '{0}'".format(options.source))
 
     options.source = os.path.abspath(options.source)
+    if options.cache_dir:
+        options.cache_dir = os.path.abspath(options.cache_dir)
     if options.output:
         options.output = os.path.abspath(options.output)
 
@@ -0,0 +1,158 @@
+import os
+import json
+import zlib
+import struct
+import contextlib
+import hashlib
+import tempfile
+
+from PIL import Image as PILImage
+
+from glue import __version__
+from glue.helpers import makedirs
+
+
+class ImageCache(object):
+    """Content-addressed cache of decoded source images.
+
+    Every entry is stored using the digest of the source image and the
+    settings that change how it is decoded as key. Entries contain the raw
+    RGBA pixels compressed using zlib, so loading them is way faster than
+    decoding (and cropping) the source image again.
+    """
+
+    # Increase this number every time the way glue decodes images changes.
+    version = 2
+    magic = 'GLUE'
+    header = struct.Struct('>4sBIIIIIIII')
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, digest, crop=False):
+        """Return the cache key for a source image.
+
+        :param digest: Digest of the source image contents.
+        :param crop: Crop flag used to decode the image.
+        """
+        key = 'glue-{0}:{1}:{2}:crop={3}'.format(__version__, self.version,
+                                                 digest, bool(crop))
+        return hashlib.sha1(key).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        """Return a tuple with the cached image, its original size and its
+        box or ``None`` if there is no valid entry for this key."""
+        try:
+            with open(self.entry_path(key), 'rb') as f:
+                header = self.header.unpack(f.read(self.header.size))
+                magic, version, width, height = header[:4]
+                if magic != self.magic or version != self.version:
+                    return None
+                data = zlib.decompress(f.read())
+        except (IOError, OSError, struct.error, zlib.error):
+            return None
+
+        if len(data) != width * height * 4:
+            return None
+
+        img = PILImage.frombytes('RGBA', (width, height), data)
+        return img, tuple(header[4:6]), tuple(header[6:])
+
+    def set(self, key, img, original_size, box):
+        """Store ``img``, its original size and its box using this key.
+        Entries are written atomically, so concurrent builds can share the
+        same cache."""
+        path = self.entry_path(key)
+        header = self.header.pack(self.magic, self.version,
+                                  img.size[0], img.size[1],
+                                  original_size[0], original_size[1], *box)
+
+        with atomic_write(path) as f:
+            f.write(header)
+            f.write(zlib.compress(img.tobytes(), 1))
+
+    def index(self, sprite_path):
+        """Return the :class:`~SourceIndex` of the sprite at this path."""
+        name = hashlib.sha1(os.path.abspath(sprite_path).encode('utf-8')).hexdigest()
+        return SourceIndex(os.path.join(self.path, 'index', '{0}.json'.format(name)))
+
+
+class SourceIndex(object):
+    """Index of the facts glue knows about the source images of a sprite
+    (digest, original size and crop box).
+
+    Entries are keyed by path and only used while the size and modification
+    time of the source image are still the same, so unchanged images don't
+    need to be opened at all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, path, stat):
+        """Return the facts stored for ``path`` or an empty dictionary if
+        there are none or the file changed since they were stored.
+
+        :param path: Source image path.
+        :param stat: Current ``os.stat`` result of ``path``.
+        """
+        entry = self.entries.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['facts']
+        return {}
+
+    def save(self, facts):
+        """Replace the content of the index and save it.
+
+        :param facts: Dictionary containing ``(stat, facts)`` for every
+                      source image path.
+        """
+        entries = {}
+        for path, (stat, image_facts) in facts.iteritems():
+            entries[path] = {'size': stat.st_size,
+                             'mtime': stat.st_mtime,
+                             'facts': image_facts}
+
+        if entries == self.entries:
+            return
+
+        self.entries = entries
+        with atomic_write(self.path) as f:
+            json.dump(entries, f)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Yield a temporary file that replaces ``path`` once it is written.
+
+    The cache is only an optimization, so if the file can't be written (or
+    can't replace an existing one in some platforms) the build goes on.
+    """
+    dirname = os.path.dirname(path)
+    tmp_path = None
+    try:
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        f = os.fdopen(fd, 'wb')
+    except (IOError, OSError):
+        # The cache directory isn't writable, so discard the content.
+        f = open(os.devnull, 'wb')
+
+    try:
+        with f:
+            yield f
+        if tmp_path:
+            os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,17 +1,121 @@
 import re
 import os
 import sys
-import copy
-import hashlib
-import StringIO
 import ConfigParser
+import multiprocessing
 
 from PIL import Image as PILImage
 
+from glue import __version__
 from glue.algorithms import algorithms
-from glue.helpers import cached_property, round_up
+from glue.helpers import (cached_property, round_up, image_size, mapped_file,
+                          mapped_sha1, hash_values, alpha_channel,
+                          LayeredConfig,
+                          walk_files, walk_order, split_patterns,
+                          file_signature)
 from glue.formats import ImageFormat
-from glue.exceptions import SourceImagesNotFoundError, PILUnavailableError
+from glue.cache import ImageCache
+from glue.pipeline import pipeline
+from glue.layout import Layout
+from glue.exceptions import (SourceImagesNotFoundError, PILUnavailableError,
+                             ValidationError)
+
+
+def decode_image(fp, crop=False):
+    """Decode the image contained in ``fp`` into a new RGBA image.
+
+    Return a tuple with the (optionally cropped) image, its original size
+    and the box of the original image it contains.
+
+    :param fp: File-like object containing the image data.
+    :param crop: Crop the image searching for the smallest possible bounding
+                 box without losing any non-transparent pixel.
+    """
+    try:
+        source_image = PILImage.open(fp)
+        img = PILImage.new('RGBA', source_image.size, (0, 0, 0, 0))
+
+        if source_image.mode == 'L':
+            # Map the transparent luminance value to 0 and everything else
+            # to 255 using a lookup table.
+            transparency = source_image.info.get('transparency')
+            mask = source_image.point([0 if a == transparency else 255 for a in xrange(256)])
+            img.paste(source_image, (0, 0), mask=mask)
+        else:
+            img.paste(source_image, (0, 0))
+    except IOError, e:
+        raise PILUnavailableError(e.args[0].split()[1])
+
+    original_size = img.size
+    box = (0, 0) + original_size
+    if crop:
+        box = alpha_channel(img).getbbox() or box
+        img = img.crop(box)
+    return img, original_size, box
+
+
+def load_image(path, crop=False, cache=None):
+    """Load the image at ``path`` from ``cache`` or decode it if it isn't
+    cached yet.
+
+    Return a tuple with the image, its original size, its box and the digest
+    of the source image (``None`` if there is no cache).
+
+    :param path: Source image path.
+    :param crop: Crop flag. See :func:`decode_image`.
+    :param cache: :class:`~glue.cache.ImageCache` to use if any.
+    """
+    digest = key = None
+    with mapped_file(path) as data:
+        if cache is not None:
+            digest = mapped_sha1(data)
+            key = cache.key(digest, crop=crop)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached + (digest,)
+        img, original_size, box = decode_image(data, crop=crop)
+
+    if cache is not None:
+        cache.set(key, img, original_size, box)
+    return img, original_size, box, digest
+
+
+def _decode_image_worker(args):
+    """Decode an image inside a worker process and return its raw RGBA
+    buffer as it is cheaper to send back than the PIL image itself."""
+    path, crop, cache_path = args
+    cache = ImageCache(cache_path) if cache_path else None
+    img, original_size, box, digest = load_image(path, crop=crop, cache=cache)
+    return img.size, img.tobytes(), original_size, box, digest
+
+
+# Parsed configuration files by path. Each entry is only used while the
+# modification time and size of the file don't change.
+_config_files = {}
+
+
+def read_config_file(path):
+    """Return a ``RawConfigParser`` with the content of the configuration
+    file at ``path``. Every file is only parsed once while it doesn't change,
+    no matter how many sprites or images read it."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ConfigParser.RawConfigParser()
+
+    key = (stat.st_mtime, stat.st_size)
+    cached = _config_files.get(path)
+    if cached is None or cached[0] != key:
+        config = ConfigParser.RawConfigParser()
+        config.read(path)
+        cached = _config_files[path] = (key, config)
+    return cached[1]
+
+
+# Digests of the source images by path. As with the configuration files,
+# each entry is only used while the modification time and size of the
+# image don't change, so unchanged images are only hashed once.
+_image_digests = {}
 
 
 class ConfigurableFromFile(object):
@@ -23,8 +127,7 @@ class ConfigurableFromFile(object):
         def clean(value):
             return {'true': True, 'false': False}.get(value.lower(), value)
 
-        config = ConfigParser.RawConfigParser()
-        config.read(os.path.join(self.config_path, filename))
+        config = read_config_file(os.path.join(self.config_path, filename))
 
         try:
             keys = config.options(section)
@@ -40,87 +143,194 @@ class ProjectConfig(ConfigurableFromFile):
 
 class Image(ConfigurableFromFile):
 
-    def __init__(self, path, config):
+    # Row of this image inside the sprite :class:`~glue.layout.Layout`.
+    layout = layout_index = None
+
+    def __init__(self, path, config, cache=None, index=None):
         self.path = path
+        self.cache = cache
+        self.index = index
         self.filename = os.path.basename(path)
         self.dirname = self.config_path = os.path.dirname(path)
 
-        self.config = copy.deepcopy(config)
-        self.config.update(self._get_config_from_file('sprite.conf', self.filename))
-
-        self.x = self.y = None
-        self.original_width = self.original_height = 0
-
-        with open(self.path, "rb") as img:
-            self._image_data = img.read()
+        self.config = LayeredConfig(config, self._get_config_from_file('sprite.conf', self.filename))
 
-        print "\t{0} added to sprite".format(self.filename)
+        # 4-elements tuples with the desired padding and margin.
+        self.padding = self._generate_spacing_info('padding')
+        self.margin = self._generate_spacing_info('margin')
 
     @cached_property
     def image(self):
         """Return a Pil representation of this image """
-        io = StringIO.StringIO(self._image_data)
-        try:
-            source_image = PILImage.open(io)
-            img = PILImage.new('RGBA', source_image.size, (0, 0, 0, 0))
-
-            if source_image.mode == 'L':
-                alpha = source_image.split()[0]
-                transparency = source_image.info.get('transparency')
-                mask = PILImage.eval(alpha, lambda a: 0 if a == transparency else 255)
-                img.paste(source_image, (0, 0), mask=mask)
-            else:
-                img.paste(source_image, (0, 0))
-        except IOError, e:
-            raise PILUnavailableError(e.args[0].split()[1])
-        finally:
-            io.close()
+        img, self.original_size, self.box, digest = load_image(self.path,
+                                                               crop=self.config['crop'],
+                                                               cache=self.cache)
+        if digest is not None:
+            self.remember_digest(digest)
+        return img
 
-        self.original_width, self.original_height = img.size
+    @property
+    def x(self):
+        """Return the X coordinate of this image inside the sprite canvas."""
+        if self.layout is None:
+            return None
+        return self.layout.x[self.layout_index]
 
-        # Crop the image searching for the smallest possible bounding box
-        # without losing any non-transparent pixel.
-        # This crop is only used if the crop flag is set in the config.
-        if self.config['crop']:
-            img = img.crop(img.split()[-1].getbbox())
-        return img
+    @x.setter
+    def x(self, value):
+        self.layout.x[self.layout_index] = value
+
+    @property
+    def y(self):
+        """Return the Y coordinate of this image inside the sprite canvas."""
+        if self.layout is None:
+            return None
+        return self.layout.y[self.layout_index]
+
+    @y.setter
+    def y(self, value):
+        self.layout.y[self.layout_index] = value
+
+    def release(self):
+        """Free the decoded pixels of this image. They will be decoded again
+        (or loaded from the cache) the next time they are needed."""
+        self.__dict__.pop('image', None)
+
+    @cached_property
+    def stat(self):
+        return os.stat(self.path)
+
+    @cached_property
+    def indexed_facts(self):
+        """Return the facts the sprite index knows about this image if the
+        source image didn't change since they were stored."""
+        if self.index is None:
+            return {}
+        return self.index.get(self.path, self.stat)
+
+    @property
+    def facts(self):
+        """Return the facts about this image worth storing in the sprite
+        index. Only the already known ones are included."""
+        facts = dict(self.indexed_facts)
+        for key in ('digest', 'original_size', 'box'):
+            if key in self.__dict__:
+                facts[key] = self.__dict__[key]
+        if not self.config['crop']:
+            facts.pop('box', None)
+        return facts
+
+    @cached_property
+    def original_size(self):
+        """Return the size of the source image reading only its header."""
+        if 'original_size' in self.indexed_facts:
+            return tuple(self.indexed_facts['original_size'])
+
+        with mapped_file(self.path) as data:
+            try:
+                size = image_size(data)
+                if size is None:
+                    # Unknown header, let PIL parse it (still without decoding).
+                    data.seek(0)
+                    size = PILImage.open(data).size
+            except IOError, e:
+                raise PILUnavailableError(e.args[0].split()[1])
+        return tuple(size)
+
+    @cached_property
+    def digest(self):
+        """Return the sha1 hexdigest of the source image contents. The
+        source image is only read if neither the sprite index nor any
+        previous build in this process already know it."""
+        if 'digest' in self.indexed_facts:
+            return self.indexed_facts['digest']
+
+        key = (self.stat.st_mtime, self.stat.st_size)
+        cached = _image_digests.get(self.path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with mapped_file(self.path) as data:
+            return self.remember_digest(mapped_sha1(data))
+
+    def remember_digest(self, digest):
+        """Store the digest of this image so the source image doesn't need
+        to be read again while it doesn't change."""
+        _image_digests[self.path] = ((self.stat.st_mtime, self.stat.st_size), digest)
+        self.digest = digest
+        return digest
+
+    @property
+    def original_width(self):
+        """Return the width of the source image."""
+        return self.original_size[0]
+
+    @property
+    def original_height(self):
+        """Return the height of the source image."""
+        return self.original_size[1]
+
+    @cached_property
+    def box(self):
+        """Return the box (left, upper, right, lower) of the source image
+        this image contains. Unless the image needs to be cropped (and its
+        crop box is not indexed), no pixel is decoded to know it."""
+        if not self.config['crop']:
+            return (0, 0) + self.original_size
+        if 'box' in self.indexed_facts:
+            return tuple(self.indexed_facts['box'])
+
+        self.image  # Decoding the image also sets its box.
+        box = self.__dict__['box']
+        if self.config.get('stream'):
+            self.release()
+        return box
+
+    @cached_property
+    def size(self):
+        """Return the size of this image. Unless the image needs to be
+        cropped, the size is read from the image header (or the sprite
+        index) and no pixel is decoded until the image is pasted into the
+        canvas."""
+        left, upper, right, lower = self.box
+        return right - left, lower - upper
 
     @property
     def width(self):
         """Return Image width"""
-        return self.image.size[0]
+        return self.size[0]
 
     @property
     def height(self):
         """Return Image height"""
-        return self.image.size[1]
+        return self.size[1]
 
-    @property
-    def padding(self):
-        """Return a 4-elements list with the desired padding."""
-        return self._generate_spacing_info(self.config['padding'])
+    def _generate_spacing_info(self, name):
+        """Return the padding or margin of this image as a 4-elements tuple
+        (top, right, bottom, left) using the same shorthands as CSS.
 
-    @property
-    def margin(self):
-        """Return a 4-elements list with the desired marging."""
-        return self._generate_spacing_info(self.config['margin'])
+        :param name: Setting to parse (``padding`` or ``margin``).
+        """
+        value = self.config[name]
 
-    def _generate_spacing_info(self, data):
+        try:
+            data = [int(v) for v in value.split(',' if ',' in value else None)]
+        except (AttributeError, ValueError):
+            data = []
 
-        data = data.split(',' if ',' in data else ' ')
+        if not 0 < len(data) <= 4 or min(data) < 0:
+            raise ValidationError(("Error: Invalid {0} '{1}' for {2}. Use up to "
+                                   "four positive integers separated by spaces "
+                                   "or commas.\n").format(name, value, self.path))
 
-        if len(data) == 4:
-            data = data
-        elif len(data) == 3:
+        if len(data) == 3:
             data = data + [data[1]]
         elif len(data) == 2:
             data = data * 2
         elif len(data) == 1:
             data = data * 4
-        else:
-            data = [0] * 4
 
-        return map(int, data)
+        return tuple(data)
 
     @cached_property
     def horizontal_spacing(self):
@@ -171,10 +381,14 @@ class Sprite(ConfigurableFromFile):
     config_section = 'sprite'
     valid_extensions = ['png', 'jpg', 'jpeg', 'gif']
 
-    def __init__(self, path, config, name=None):
+    # Settings that only change how glue runs, never what it builds.
+    run_options = ('jobs', 'max_memory', 'quiet', 'cache_dir', 'force',
+                   'watch', 'debug')
+
+    def __init__(self, path, config, name=None, files=None):
         self.path = self.config_path = path
-        self.config = copy.deepcopy(config)
-        self.config.update(self._get_config_from_file('sprite.conf', 'sprite'))
+        self.files = files
+        self.config = LayeredConfig(config, self._get_config_from_file('sprite.conf', 'sprite'))
         self.name = name or self.config.get('name', os.path.basename(path))
 
         # Setup ratios
@@ -189,66 +403,202 @@ class Sprite(ConfigurableFromFile):
         self.max_ratio = max(self.ratios)
         self.config['ratios'] = self.ratios
 
-        # Discover images inside this sprite
-        self.images = self._locate_images()
+        cache_dir = self.config.get('cache_dir')
+        self.cache = ImageCache(cache_dir) if cache_dir else None
+        self.index = self.cache.index(self.path) if self.cache else None
 
-        img_format = ImageFormat(sprite=self)
-        for ratio in ratios:
-            ratio_output_key = 'ratio_{0}_output'.format(ratio)
-            if ratio_output_key not in self.config:
-                self.config[ratio_output_key] = img_format.output_path(ratio)
+        # Duplicated images pointing to the image packed instead of them.
+        self.duplicates = {}
+
+    @cached_property
+    def images(self):
+        """Return the images of this sprite. They are only discovered (and
+        the sprite only processed) if some format needs them."""
+        return self._locate_images()
 
+    @cached_property
+    def layout(self):
+        """Return the :class:`~glue.layout.Layout` of this sprite."""
+        self.images  # Images are added to the sprite before processing it.
         print "Processing '{0}':".format(self.name)
 
         # Generate sprite map
         self.process()
+        return self.layout
 
     def process(self):
+        if self.config.get('deduplicate'):
+            images = self._deduplicate_images()
+        else:
+            images = self.images
+
+        self.layout = Layout(images)
         algorithm_cls = algorithms[self.config['algorithm']]
         algorithm = algorithm_cls()
         algorithm.process(self)
 
+        # Duplicated images share the layout row of the first one.
+        for image in self.images:
+            if image.layout is None:
+                original = self.duplicates[image]
+                image.layout, image.layout_index = original.layout, original.layout_index
+
+    @cached_property
+    def fingerprint(self):
+        """Return a hash of everything the outputs of this sprite depend on
+        that can be known without opening any image: the settings of the
+        sprite, and the path, size and modification time of every source
+        image, configuration file and custom template. Settings listed in
+        ``run_options`` are left out.
+
+        If the fingerprint didn't change since the outputs were built,
+        there is no need to discover, decode or pack the images at all.
+        """
+        config_paths = set([os.path.join(self.path, self.config_filename)])
+
+        def values():
+            yield __version__
+            for key, value in sorted(self.config.iteritems()):
+                # Output paths are derived from the rest of the settings.
+                if key.startswith('ratio_') and key.endswith('_output'):
+                    continue
+                if key in self.run_options:
+                    continue
+                yield key
+                yield value
+                if key.endswith('_template') and value:
+                    config_paths.add(value)
+
+            for path in self.source_paths():
+                config_paths.add(os.path.join(os.path.dirname(path), self.config_filename))
+                yield os.path.relpath(path, self.path)
+                yield file_signature(path)
+
+            for path in sorted(config_paths):
+                yield path
+                yield file_signature(path)
+
+        return hash_values(values())
+
+    def _deduplicate_images(self):
+        """Return the list of images with different contents.
+
+        Images with the same contents and spacing settings are only packed
+        once and every duplicated image is added to ``self.duplicates``
+        pointing to the first one.
+        """
+        unique = {}
+        images = []
+        for image in self.images:
+            key = (image.digest, bool(image.config['crop']), image.padding, image.margin)
+            if key in unique:
+                self.duplicates[image] = unique[key]
+            else:
+                unique[key] = image
+                images.append(image)
+
+        if self.duplicates:
+            pixels = sum([i.absolute_width * i.absolute_height for i in self.duplicates])
+            size = sum([i.stat.st_size for i in self.duplicates])
+            print ("\t{0} duplicated images packed only once "
+                   "({1} pixels and {2} bytes saved)").format(len(self.duplicates), pixels, size)
+        return images
+
     def validate(self):
-        pass
+        heuristic = self.config.get('maxrects_heuristic')
+        heuristics = algorithms['maxrects'].heuristics
+        if heuristic and heuristic not in heuristics:
+            raise ValidationError(("Error: Invalid maxrects_heuristic '{0}' for {1}. "
+                                   "Use one of: {2}.\n").format(heuristic, self.path,
+                                                               ', '.join(sorted(heuristics))))
 
     @cached_property
     def hash(self):
-        """ Return a hash of this sprite. In order to detect any change on
-        the source images  it use the data, order and path of each image.
-        In the same way it use this sprite settings as part of the hash.
+        """Return a hash of the image of this sprite. In order to detect
+        any change on the source images it uses the digest, order, path
+        (relative to the sprite) and settings of each image. In the same
+        way it uses the sprite settings that change the image (see
+        :attr:`~glue.formats.ImageFormat.hash_options`), so changing any
+        other setting doesn't need a new image. The version of glue is
+        used too, so upgrading glue builds the image again.
+
+        The digest of every image is cached, so unchanged source images are
+        not read again.
         """
-        hash_list = []
-        for image in self.images:
-            hash_list.append(os.path.relpath(image.path))
-            hash_list.append(image._image_data)
+        def values():
+            yield __version__
+            for image in self.images:
+                yield os.path.relpath(image.path, self.path)
+                yield image.digest
+                yield (bool(image.config['crop']), image.padding, image.margin)
 
-        for key, value in self.config.iteritems():
-            hash_list.append(key)
-            hash_list.append(value)
+            for key in ImageFormat.hash_options:
+                yield key
+                yield self.config.get(key)
 
-        return hashlib.sha1(''.join(map(str, hash_list))).hexdigest()[:10]
+        return hash_values(values())
 
     @cached_property
     def canvas_size(self):
         """Return the width and height for this sprite canvas"""
-        width = height = 0
-        for image in self.images:
-            x = image.x + image.absolute_width
-            y = image.y + image.absolute_height
-            if width < x:
-                width = x
-            if height < y:
-                height = y
+        width, height = self.layout.size
         return round_up(width), round_up(height)
 
+    def save_index(self):
+        """Store what is known about every image in the sprite index, so
+        the next build doesn't need to open the unchanged ones. Nothing is
+        stored if the images of this sprite weren't needed at all."""
+        if self.index is not None and 'images' in self.__dict__:
+            self.index.save(dict((image.path, (image.stat, image.facts)) for image in self.images))
+
+    def estimated_pixels(self):
+        """Return the number of pixels of all the source images of this
+        sprite reading only their headers. It is used to know how expensive
+        building this sprite is before processing it."""
+        pixels = 0
+        for path in self.source_paths():
+            with mapped_file(path) as data:
+                size = image_size(data)
+            if size is not None:
+                pixels += size[0] * size[1]
+        return pixels
+
     def sprite_path(self, ratio=1.0):
-        return self.config['ratio_{0}_output'.format(ratio)]
+        ratio_output_key = 'ratio_{0}_output'.format(ratio)
+        if ratio_output_key not in self.config:
+            self.config[ratio_output_key] = ImageFormat(sprite=self).output_path(ratio)
+        return self.config[ratio_output_key]
 
-    def _locate_images(self):
-        """Return all valid images within a folder.
+    def source_paths(self):
+        """Return the path of every source image of this sprite (or the
+        list of files of this sprite if there is one).
 
         All files with a extension not included in
-        (png, jpg, jpeg and gif) or beginning with '.' will be ignored.
+        (png, jpg, jpeg and gif) or beginning with '.' will be ignored, as
+        well as any file or directory matching the ``exclude`` patterns (or
+        not matching the ``include`` ones if there are any).
+        """
+        extensions = '|'.join(self.valid_extensions)
+        extension_re = re.compile('.+\.(%s)$' % extensions, re.IGNORECASE)
+
+        # If the list of files is known beforehand the folder is not walked.
+        if self.files is not None:
+            paths = walk_order(set(self.files), self.path)
+        else:
+            paths = walk_files(self.path,
+                               recursive=self.config['recursive'],
+                               follow_links=self.config['follow_links'],
+                               include=split_patterns(self.config.get('include')),
+                               exclude=split_patterns(self.config.get('exclude')))
+
+        for path in paths:
+            filename = os.path.basename(path)
+            if not filename.startswith('.') and extension_re.match(filename):
+                yield path
+
+    def _locate_images(self):
+        """Return all valid images of this sprite (see
+        :meth:`source_paths`).
 
         If the folder doesn't contain any valid image it will raise
         :class:`~SourceImagesNotFoundError`
@@ -256,21 +606,65 @@ class Sprite(ConfigurableFromFile):
         The list of images will be ordered using the desired ordering
         algorithm. The default is 'maxside'.
         """
-        extensions = '|'.join(self.valid_extensions)
-        extension_re = re.compile('.+\.(%s)$' % extensions, re.IGNORECASE)
-        files = sorted(os.listdir(self.path))
+        decode_in_processes = self._decodes_in_processes()
+
+        def load(path):
+            image = Image(path=path, config=self.config, cache=self.cache, index=self.index)
+            if not decode_in_processes:
+                # Read the header (or decode and crop the image) while the
+                # folder is still being walked.
+                image.size
+            return image
 
         images = []
-        for root, dirs, files in os.walk(self.path, followlinks=self.config['follow_links']):
-            for filename in sorted(files):
-                if not filename.startswith('.') and extension_re.match(filename):
-                    images.append(Image(path=os.path.join(root, filename), config=self.config))
-            if not self.config['recursive']:
-                break
+        for image in pipeline(load, self.source_paths()):
+            print "\t{0} added to sprite".format(image.filename)
+            images.append(image)
 
         if not images:
             raise SourceImagesNotFoundError(self.path)
 
+        if decode_in_processes:
+            # Sorting needs the size of every image, and only the crop box
+            # of the images cropped needs their pixels.
+            self.decode_images([image for image in images if image.config['crop'] and
+                                'box' not in image.indexed_facts])
+
         images = sorted(images, reverse=self.config['algorithm_ordering'][0] != '-')
 
         return images
+
+    def _decodes_in_processes(self):
+        # Decoding all the images up front would keep all of them in memory.
+        return int(self.config.get('jobs') or 1) > 1 and not self.config.get('stream')
+
+    def decode_images(self, images):
+        """Decode the pixels of the ``images`` not decoded yet using a pool
+        of ``jobs`` processes. Nothing is done if images are decoded one by
+        one when they are needed (a single job or streaming mode)."""
+        images = [image for image in images if 'image' not in image.__dict__]
+        if self._decodes_in_processes() and len(images) > 1:
+            self._decode_images(images, int(self.config['jobs']))
+
+    def _decode_images(self, images, jobs):
+        """Decode, convert and crop ``images`` using a pool of ``jobs``
+        processes. Every worker sends back the RGBA buffer of its image, so
+        the result is exactly the same as decoding them one by one.
+        """
+        cache_path = self.cache.path if self.cache else None
+        tasks = [(image.path, image.config['crop'], cache_path) for image in images]
+        chunksize = max(1, len(tasks) // (jobs * 4))
+
+        pool = multiprocessing.Pool(processes=jobs)
+        try:
+            results = pool.map(_decode_image_worker, tasks, chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for image, (size, data, original_size, box, digest) in zip(images, results):
+            image.image = PILImage.frombytes('RGBA', size, data)
+            image.original_size = original_size
+            image.box = box
+            if digest is not None:
+                image.remember_digest(digest)
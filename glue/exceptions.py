@@ -21,3 +21,8 @@ class SourceImagesNotFoundError(GlueError):
 class NoSpritesFoldersFoundError(GlueError):
     """Raised if no sprites folders could be found."""
     error_code = 5
+
+
+class SpriteWorkerError(Exception):
+    """Raised if building a sprite inside a worker process fails
+    unexpectedly. The message is the traceback of the worker."""
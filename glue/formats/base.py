@@ -6,7 +6,8 @@ import textwrap
 
 from jinja2 import Template
 
-from glue.helpers import round_up, nearest_fration
+from glue.helpers import (round_up, nearest_fration, cached_property, hash_values,
+                          makedirs)
 from glue import __version__
 
 
@@ -15,6 +16,13 @@ class BaseFormat(object):
     extension = None
     build_per_ratio = False
 
+    # Settings that change the output of this format. Changing any other
+    # setting doesn't rebuild it.
+    hash_options = ()
+
+    # :class:`~glue.manifest.BuildManifest` of the output directory.
+    manifest = None
+
     def __init__(self, sprite):
         self.sprite = sprite
 
@@ -44,9 +52,77 @@ class BaseFormat(object):
     def save(self, *args, **kwargs):
         raise NotImplementedError
 
+    def output_paths(self):
+        """Return the paths of every file this format builds."""
+        if self.build_per_ratio:
+            return [self.output_path(ratio) for ratio in self.sprite.config['ratios']]
+        return [self.output_path()]
+
+    @property
+    def manifest_key(self):
+        return '{0}:{1}'.format(self.format_label, self.sprite.name)
+
     def needs_rebuild(self):
+        """Return ``True`` if the files of this format need to be built.
+
+        If the build manifest knows these files the answer only needs to
+        stat them. Otherwise the files built by older versions of glue
+        are checked using :meth:`outputs_outdated`.
+        """
+        if self.manifest is not None:
+            up_to_date = self.manifest.get(self.manifest_key, self.hash,
+                                           self.output_paths())
+            if up_to_date is not None:
+                return not up_to_date
+        return self.outputs_outdated()
+
+    def outputs_outdated(self):
+        """Return ``True`` unless the previous output of this format, if
+        any, contains the current hash."""
         return True
 
+    def is_fresh(self):
+        """Return ``True`` if the files of this format were built from a
+        sprite with the same fingerprint, so there is no need to even
+        process the sprite to know they are up to date."""
+        if self.manifest is None:
+            return False
+        # Names containing the hash are only known processing the sprite,
+        # but the fingerprint already includes the settings naming them.
+        paths = None if self.outputs_named_by_hash else self.output_paths()
+        return self.manifest.fresh(self.manifest_key, self.sprite.fingerprint, paths)
+
+    @property
+    def outputs_named_by_hash(self):
+        """Return ``True`` if the names of the files of this format contain
+        the hash of the sprite."""
+        return False
+
+    def record(self):
+        """Record the current files of this format in the build manifest."""
+        if self.manifest is not None:
+            self.manifest.record(self.manifest_key, self.hash, self.output_paths(),
+                                 fingerprint=self.sprite.fingerprint)
+
+    @cached_property
+    def hash(self):
+        """Return a hash of the output of this format. It uses the hash of
+        the sprite image, the settings listed in ``hash_options`` and any
+        other value returned by :meth:`hash_values`."""
+        def values():
+            yield __version__
+            yield self.sprite.hash
+            for key in self.hash_options:
+                yield key
+                yield self.sprite.config.get(key)
+            for value in self.hash_values():
+                yield value
+        return hash_values(values())
+
+    def hash_values(self):
+        """Return any other value the output of this format depends on."""
+        return []
+
     def validate(self):
         pass
 
@@ -73,11 +149,20 @@ class BaseFormat(object):
 
 class BaseTextFormat(BaseFormat):
 
+    def hash_values(self):
+        """Text formats also depend on the name of the sprite and on the
+        path of its images relative to their own output directory."""
+        values = [self.sprite.name]
+        for ratio in self.sprite.ratios:
+            values.append(os.path.relpath(self.sprite.sprite_path(ratio=ratio), self.output_dir()))
+        return values
+
     def get_context(self, *args, **kwargs):
         sprite_path = os.path.relpath(self.sprite.sprite_path(), self.output_dir())
         sprite_path = self.fix_windows_path(sprite_path)
         context = {'version': __version__,
                    'hash': self.sprite.hash,
+                   'format_hash': self.hash,
                    'name': self.sprite.name,
                    'sprite_path': sprite_path,
                    'sprite_filename': os.path.basename(sprite_path),
@@ -86,33 +171,42 @@ class BaseTextFormat(BaseFormat):
                    'images': [],
                    'ratios': {}}
 
+        layout = self.sprite.layout
+        max_ratio = self.sprite.max_ratio
+        last = len(self.sprite.images) - 1
+
         for i, img in enumerate(self.sprite.images):
-            base_x = img.x * -1 - img.margin[3] * self.sprite.max_ratio
-            base_y = img.y * -1 - img.margin[0] * self.sprite.max_ratio
-            base_abs_x = img.x + img.margin[3] * self.sprite.max_ratio
-            base_abs_y = img.y + img.margin[0] * self.sprite.max_ratio
+            row = img.layout_index
+            x, y = layout.x[row], layout.y[row]
+            width, height = layout.width[row], layout.height[row]
+            padding, margin = layout.spacing(row)
+
+            base_x = x * -1 - margin[3] * max_ratio
+            base_y = y * -1 - margin[0] * max_ratio
+            base_abs_x = x + margin[3] * max_ratio
+            base_abs_y = y + margin[0] * max_ratio
 
             image = dict(filename=img.filename,
-                         last=i == len(self.sprite.images) - 1,
-                         x=round_up(base_x / self.sprite.max_ratio),
-                         y=round_up(base_y / self.sprite.max_ratio),
-                         abs_x=round_up(base_abs_x / self.sprite.max_ratio),
-                         abs_y=round_up(base_abs_y / self.sprite.max_ratio),
-                         height=round_up((img.height / self.sprite.max_ratio) + img.padding[0] + img.padding[2]),
-                         width=round_up((img.width / self.sprite.max_ratio) + img.padding[1] + img.padding[3]),
+                         last=i == last,
+                         x=round_up(base_x / max_ratio),
+                         y=round_up(base_y / max_ratio),
+                         abs_x=round_up(base_abs_x / max_ratio),
+                         abs_y=round_up(base_abs_y / max_ratio),
+                         height=round_up((height / max_ratio) + padding[0] + padding[2]),
+                         width=round_up((width / max_ratio) + padding[1] + padding[3]),
                          original_width=img.original_width,
                          original_height=img.original_height,
                          ratios={})
 
             for r in self.sprite.ratios:
                 image['ratios'][r] = dict(filename=img.filename,
-                                          last=i == len(self.sprite.images) - 1,
-                                          x=round_up(base_x / self.sprite.max_ratio * r),
-                                          y=round_up(base_y / self.sprite.max_ratio * r),
-                                          abs_x=round_up(base_abs_x / self.sprite.max_ratio * r),
-                                          abs_y=round_up(base_abs_y / self.sprite.max_ratio * r),
-                                          height=round_up((img.height + img.padding[0] + img.padding[2]) / self.sprite.max_ratio * r),
-                                          width=round_up((img.width + img.padding[1] + img.padding[3]) / self.sprite.max_ratio * r))
+                                          last=i == last,
+                                          x=round_up(base_x / max_ratio * r),
+                                          y=round_up(base_y / max_ratio * r),
+                                          abs_x=round_up(base_abs_x / max_ratio * r),
+                                          abs_y=round_up(base_abs_y / max_ratio * r),
+                                          height=round_up((height + padding[0] + padding[2]) / max_ratio * r),
+                                          width=round_up((width + padding[1] + padding[3]) / max_ratio * r))
 
             context['images'].append(image)
 
@@ -134,8 +228,7 @@ class BaseTextFormat(BaseFormat):
 
     def save(self, *args, **kwargs):
         # Create the destination directory if required
-        if not os.path.exists(self.output_dir(*args, **kwargs)):
-            os.makedirs(self.output_dir(*args, **kwargs))
+        makedirs(self.output_dir(*args, **kwargs))
 
         with codecs.open(self.output_path(*args, **kwargs), 'w', 'utf-8-sig') as f:
             f.write(self.render(*args, **kwargs))
@@ -145,17 +238,14 @@ class BaseJSONFormat(BaseTextFormat):
 
     meta_key = 'meta'
 
-    def needs_rebuild(self):
+    def outputs_outdated(self):
         for ratio in self.sprite.config['ratios']:
-            json_path = self.output_path(ratio)
-            if os.path.exists(json_path):
-                with codecs.open(json_path, 'r', 'utf-8-sig') as f:
-                    try:
-                        data = json.loads(f.read())
-                        assert data[self.meta_key]['hash'] == self.sprite.hash
-                    except Exception:
-                        continue
-            return True
+            try:
+                with codecs.open(self.output_path(ratio), 'r', 'utf-8-sig') as f:
+                    data = json.loads(f.read())
+                assert data[self.meta_key]['hash'] == self.hash
+            except Exception:
+                return True
         return False
 
     def render(self, *args, **kwargs):
@@ -170,16 +260,13 @@ class BasePlistFormat(BaseTextFormat):
         context = self.get_context(*args, **kwargs)
         return plistlib.writePlistToString(context)
 
-    def needs_rebuild(self):
+    def outputs_outdated(self):
         for ratio in self.sprite.config['ratios']:
-            cocos2d_path = self.output_path(ratio)
-            if os.path.exists(cocos2d_path):
-                try:
-                    data = plistlib.readPlist(cocos2d_path)
-                    assert data[self.meta_key]['hash'] == self.sprite.hash
-                except Exception:
-                    continue
-            return True
+            try:
+                data = plistlib.readPlist(self.output_path(ratio))
+                assert data[self.meta_key]['hash'] == self.hash
+            except Exception:
+                return True
         return False
 
 
@@ -187,11 +274,19 @@ class JinjaTextFormat(BaseTextFormat):
 
     template = ''
 
-    def render(self, *args, **kwargs):
-        context = self.get_context(*args, **kwargs)
+    def hash_values(self):
+        """Use the template itself instead of its path, so editing a
+        custom template also rebuilds this format."""
+        return super(JinjaTextFormat, self).hash_values() + [self.get_template()]
+
+    def get_template(self):
         template = self.template
         custom_template_config = '{0}_template'.format(self.format_label)
         if self.sprite.config.get(custom_template_config):
             with open(self.sprite.config[custom_template_config]) as f:
                 template = f.read()
-        return Template(textwrap.dedent(template).strip()).render(**context)
+        return template
+
+    def render(self, *args, **kwargs):
+        context = self.get_context(*args, **kwargs)
+        return Template(textwrap.dedent(self.get_template()).strip()).render(**context)
@@ -24,7 +24,7 @@ class CAATFormat(BaseJSONFormat):
         context = super(CAATFormat, self).get_context(*args, **kwargs)
 
         data = dict(sprites={}, meta={'version': context['version'],
-                                      'hash': context['hash'],
+                                      'hash': context['format_hash'],
                                       'sprite_filename': context['sprite_filename'],
                                       'width': context['width'],
                                       'height': context['height']})
@@ -12,12 +12,16 @@ class CssFormat(JinjaTextFormat):
 
     extension = 'css'
     camelcase_separator = 'camelcase'
+    hash_options = ('css_namespace', 'css_sprite_namespace', 'css_url',
+                    'css_cachebuster', 'css_cachebuster_filename',
+                    'css_cachebuster_only_sprites', 'css_separator',
+                    'css_pseudo_class_separator')
     css_pseudo_classes = set(['link', 'visited', 'active', 'hover', 'focus',
                               'first-letter', 'first-line', 'first-child',
                               'before', 'after'])
 
     template = u"""
-        /* glue: {{ version }} hash: {{ hash }} */
+        /* glue: {{ version }} hash: {{ format_hash }} */
         {% for image in images %}.{{ image.label }}{{ image.pseudo }}{%- if not image.last %}, {%- endif %}{%- endfor %}{
             background-image:url('{{ sprite_path }}');
             background-repeat:no-repeat;
@@ -130,8 +134,8 @@ class CssFormat(JinjaTextFormat):
         if sum(cachebusters) > 1:
             parser.error("You can't use --cachebuster, --cachebuster-filename or --cachebuster-filename-only-sprites at the same time.")
 
-    def needs_rebuild(self):
-        hash_line = '/* glue: %s hash: %s */\n' % (__version__, self.sprite.hash)
+    def outputs_outdated(self):
+        hash_line = '/* glue: %s hash: %s */\n' % (__version__, self.hash)
         try:
             with codecs.open(self.output_path(), 'r', 'utf-8-sig') as existing_css:
                 first_line = existing_css.readline()
@@ -150,10 +154,14 @@ class CssFormat(JinjaTextFormat):
 
     def output_filename(self, *args, **kwargs):
         filename = super(CssFormat, self).output_filename(*args, **kwargs)
-        if self.sprite.config['css_cachebuster_filename']:
+        if self.outputs_named_by_hash:
             return '{0}_{1}'.format(filename, self.sprite.hash)
         return filename
 
+    @property
+    def outputs_named_by_hash(self):
+        return bool(self.sprite.config['css_cachebuster_filename'])
+
     def get_context(self, *args, **kwargs):
 
         context = super(CssFormat, self).get_context(*args, **kwargs)
@@ -48,12 +48,19 @@ class HtmlFormat(CssFormat):
         if 'html' in options.enabled_formats and 'css' not in options.enabled_formats:
             parser.error("You can't use --html without --css.")
 
+    @property
+    def css_path(self):
+        return os.path.relpath(os.path.join(self.sprite.config['css_dir'], '{0}.css'.format(self.sprite.name)), self.output_dir())
+
+    def hash_values(self):
+        return super(HtmlFormat, self).hash_values() + [self.css_path]
+
     def get_context(self, *args, **kwargs):
         context = super(HtmlFormat, self).get_context(*args, **kwargs)
-        context['css_path'] = os.path.relpath(os.path.join(self.sprite.config['css_dir'], '{0}.css'.format(self.sprite.name)), self.output_dir())
+        context['css_path'] = self.css_path
         return context
 
-    def needs_rebuild(self):
+    def outputs_outdated(self):
         return True
 
     def validate(self):
@@ -1,18 +1,30 @@
 import os
+from itertools import izip
 
 from PIL import Image as PILImage
 from PIL import PngImagePlugin
 
 from glue import __version__
-from glue.helpers import round_up, cached_property
+from glue.helpers import round_up, cached_property, alpha_channel, png_text, makedirs
+from glue.pipeline import pipeline
 from .base import BaseFormat
 
 
+# Lookup table used to get the png8 transparency mask from the alpha band.
+# Set all pixel values below 128 to 255, and the rest to 0.
+PNG8_MASK_TABLE = [255 if a <= 128 else 0 for a in xrange(256)]
+
+
 class ImageFormat(BaseFormat):
 
     build_per_ratio = True
     extension = 'png'
 
+    # The hash of the sprite image is :attr:`~glue.core.Sprite.hash`, which
+    # uses these settings as well as the source images.
+    hash_options = ('algorithm', 'algorithm_ordering', 'maxrects_heuristic',
+                    'crop', 'padding', 'margin', 'ratios', 'png8', 'deduplicate')
+
     @classmethod
     def populate_argument_parser(cls, parser):
         group = parser.add_argument_group("Sprite image options")
@@ -48,6 +60,20 @@ class ImageFormat(BaseFormat):
                            default=os.environ.get('GLUE_MARGIN', '0'),
                            help="Force this margin in all images")
 
+        group.add_argument("--deduplicate",
+                           dest="deduplicate",
+                           action="store_true",
+                           default=os.environ.get('GLUE_DEDUPLICATE', False),
+                           help=("Pack identical source images only once "
+                                 "and make all of them use the same position"))
+
+        group.add_argument("--stream",
+                           dest="stream",
+                           action="store_true",
+                           default=os.environ.get('GLUE_STREAM', False),
+                           help=("Decode the source images one at a time while "
+                                 "composing the sprite to reduce memory usage"))
+
         group.add_argument("--png8",
                            action="store_true",
                            dest="png8",
@@ -70,18 +96,27 @@ class ImageFormat(BaseFormat):
 
     def output_filename(self, *args, **kwargs):
         filename = super(ImageFormat, self).output_filename(*args, **kwargs)
-        if self.sprite.config['css_cachebuster_filename'] or self.sprite.config['css_cachebuster_only_sprites']:
+        if self.outputs_named_by_hash:
             return '{0}_{1}'.format(filename, self.sprite.hash)
         return filename
 
-    def needs_rebuild(self):
+    @property
+    def outputs_named_by_hash(self):
+        return bool(self.sprite.config['css_cachebuster_filename'] or
+                    self.sprite.config['css_cachebuster_only_sprites'])
+
+    @property
+    def hash(self):
+        return self.sprite.hash
+
+    def outputs_outdated(self):
         for ratio in self.sprite.config['ratios']:
             image_path = self.output_path(ratio)
             try:
-                existing = PILImage.open(image_path)
-                assert existing.info['Software'] == 'glue-%s' % __version__
-                assert existing.info['Comment'] == self.sprite.hash
-                continue
+                with open(image_path, 'rb') as f:
+                    text = png_text(f)
+                assert text['Software'] == 'glue-%s' % __version__
+                assert text['Comment'] == self.sprite.hash
             except Exception:
                 return True
         return False
@@ -92,11 +127,20 @@ class ImageFormat(BaseFormat):
         width, height = self.sprite.canvas_size
         canvas = PILImage.new('RGBA', (width, height), (0, 0, 0, 0))
 
-        # Paste the images inside the canvas
-        for image in self.sprite.images:
-            canvas.paste(image.image,
-                (round_up(image.x + (image.padding[3] + image.margin[3]) * self.sprite.max_ratio),
-                 round_up(image.y + (image.padding[0] + image.margin[0]) * self.sprite.max_ratio)))
+        # Paste the images inside the canvas while the next ones are decoded.
+        # In streaming mode every image is freed as soon as it is pasted, so
+        # only the few images decoded ahead are kept in memory.
+        layout = self.sprite.layout
+        stream = self.sprite.config.get('stream')
+        self.sprite.decode_images(layout.images)
+        decoded = pipeline(lambda image: image.image, layout.images)
+        for row, (image, img) in enumerate(izip(layout.images, decoded)):
+            padding, margin = layout.spacing(row)
+            canvas.paste(img,
+                (round_up(layout.x[row] + (padding[3] + margin[3]) * self.sprite.max_ratio),
+                 round_up(layout.y[row] + (padding[0] + margin[0]) * self.sprite.max_ratio)))
+            if stream:
+                image.release()
 
         meta = PngImagePlugin.PngInfo()
         meta.add_text('Software', 'glue-%s' % __version__)
@@ -107,41 +151,42 @@ class ImageFormat(BaseFormat):
 
         if self.sprite.config['png8']:
             # Get the alpha band
-            alpha = canvas.split()[-1]
+            alpha = alpha_channel(canvas)
             canvas = canvas.convert('RGB'
                         ).convert('P',
                                   palette=PILImage.ADAPTIVE,
                                   colors=255)
 
-            # Set all pixel values below 128 to 255, and the rest to 0
-            mask = PILImage.eval(alpha, lambda a: 255 if a <= 128 else 0)
+            mask = alpha.point(PNG8_MASK_TABLE)
 
             # Paste the color of index 255 and use alpha as a mask
             canvas.paste(255, mask)
             kwargs.update({'transparency': 255})
         return canvas, kwargs
 
+    def build(self):
+        # Compose the canvas only once and then resize and encode every
+        # ratio at the same time. PIL doesn't hold the GIL while resizing
+        # and zlib while compressing, so building all of them takes about
+        # as long as the biggest one.
+        self._raw_canvas
+        ratios = self.sprite.config['ratios']
+        for _ in pipeline(lambda ratio: self.save(ratio=ratio), ratios, threads=len(ratios)):
+            pass
+
     def save(self, ratio):
         width, height = self.sprite.canvas_size
         canvas, kwargs = self._raw_canvas
 
-        # Loop all over the ratios and save one image for each one
-        for ratio in self.sprite.config['ratios']:
-
-            # Create the destination directory if required
-            if not os.path.exists(self.output_dir(ratio=ratio)):
-                os.makedirs(self.output_dir(ratio=ratio))
-
-            image_path = self.output_path(ratio=ratio)
+        # Create the destination directory if required
+        makedirs(self.output_dir(ratio=ratio))
 
-            # If this canvas isn't the biggest one scale it using the ratio
-            if self.sprite.max_ratio != ratio:
+        image_path = self.output_path(ratio=ratio)
 
-                reduced_canvas = canvas.resize(
-                                    (round_up((width / self.sprite.max_ratio) * ratio),
-                                     round_up((height / self.sprite.max_ratio) * ratio)),
-                                     PILImage.ANTIALIAS)
-                reduced_canvas.save(image_path, **kwargs)
-                # TODO: Use Imagemagick if it's available
-            else:
-                canvas.save(image_path, **kwargs)
+        # If this canvas isn't the biggest one scale it using the ratio
+        if self.sprite.max_ratio != ratio:
+            canvas = canvas.resize((round_up((width / self.sprite.max_ratio) * ratio),
+                                    round_up((height / self.sprite.max_ratio) * ratio)),
+                                   PILImage.ANTIALIAS)
+            # TODO: Use Imagemagick if it's available
+        canvas.save(image_path, **kwargs)
@@ -7,7 +7,7 @@ class LessFormat(CssFormat):
 
     extension = 'less'
     template = u"""
-        /* glue: {{ version }} hash: {{ hash }} */
+        /* glue: {{ version }} hash: {{ format_hash }} */
         {% for image in images %}.{{ image.label }}{{ image.pseudo }}{%- if not image.last %}, {%- endif %}{%- endfor %}{
             background-image:url('{{ sprite_path }}');
             background-repeat:no-repeat;
@@ -1,8 +1,22 @@
 import os
 import sys
+import mmap
+import stat
+import errno
+import struct
+import fnmatch
+import hashlib
 import contextlib
 from StringIO import StringIO
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 def round_up(value):
     int_value = int(value)
@@ -24,6 +38,324 @@ def nearest_fration(value):
         return '%i/100' % int(float(value) * 100)
 
 
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# JPEG markers containing the frame header (SOF0-SOF15 without DHT, JPG
+# and DAC as they share the same range).
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def image_size(fp):
+    """Return the ``(width, height)`` of the PNG, GIF or JPEG image contained
+    in ``fp`` reading only its header. Return ``None`` if the format is
+    unknown or the header is not valid.
+
+    :param fp: File-like object positioned at the beginning of the image.
+    """
+    head = fp.read(24)
+
+    if head.startswith(PNG_SIGNATURE) and head[12:16] == 'IHDR':
+        return struct.unpack('>II', head[16:24])
+
+    if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+
+    if head.startswith('\xff\xd8'):
+        fp.seek(2)
+        while True:
+            byte = fp.read(1)
+            # Skip everything until the next marker and its fill bytes.
+            while byte and byte != '\xff':
+                byte = fp.read(1)
+            while byte == '\xff':
+                byte = fp.read(1)
+            if not byte:
+                return None
+
+            marker = ord(byte)
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                continue  # Standalone markers without length.
+            if marker in (0xD9, 0xDA):
+                return None  # End of image or start of scan without SOF.
+
+            data = fp.read(2)
+            if len(data) != 2:
+                return None
+            length = struct.unpack('>H', data)[0]
+
+            if marker in JPEG_SOF_MARKERS:
+                data = fp.read(5)
+                if len(data) != 5:
+                    return None
+                height, width = struct.unpack('>xHH', data)
+                return width, height
+            fp.seek(length - 2, os.SEEK_CUR)
+
+    return None
+
+
+def png_text(fp):
+    """Return a dictionary with the ``tEXt`` chunks of the PNG image
+    contained in ``fp``. Only the chunk headers (and the text chunks) before
+    the image data are read, so it doesn't matter how big the image is.
+    Return ``None`` if ``fp`` doesn't contain a PNG image.
+
+    :param fp: File-like object positioned at the beginning of the image.
+    """
+    if fp.read(8) != PNG_SIGNATURE:
+        return None
+
+    text = {}
+    while True:
+        header = fp.read(8)
+        if len(header) != 8:
+            return text
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type in ('IDAT', 'IEND'):
+            return text
+
+        if chunk_type == 'tEXt':
+            data = fp.read(length)
+            if len(data) != length:
+                return text
+            key, _, value = data.partition('\0')
+            text[key] = value
+            fp.seek(4, os.SEEK_CUR)  # CRC
+        else:
+            fp.seek(length + 4, os.SEEK_CUR)
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    """Map the file at ``path`` read-only in memory and yield the mapping,
+    which can be used both as a file-like object and as a buffer without
+    copying its contents. Empty files can't be mapped, so an empty
+    ``StringIO`` is yielded instead."""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            data = StringIO(f.read())
+    try:
+        yield data
+    finally:
+        data.close()
+
+
+def mapped_sha1(data):
+    """Return the sha1 hexdigest of a mapping yielded by :func:`mapped_file`."""
+    if isinstance(data, StringIO):
+        data = data.getvalue()
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_values(values):
+    """Return the first 10 characters of the sha1 hexdigest of ``values``.
+
+    Values are fed to the hash one at a time (and separated from each
+    other), so no string containing all of them is ever built.
+
+    :param values: Iterable of values. Anything but strings is hashed
+                   using its ``repr``.
+    """
+    sha1 = hashlib.sha1()
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = repr(value)
+        sha1.update(value)
+        sha1.update('\0')
+    return sha1.hexdigest()[:10]
+
+
+def alpha_channel(img):
+    """Return the alpha band of an RGBA image without splitting (and
+    copying) every other band if this version of PIL allows it."""
+    if hasattr(img, 'getchannel'):
+        return img.getchannel('A')
+    return img.split()[-1]
+
+
+class LayeredConfig(object):
+    """Dictionary-like configuration which only stores its own overrides and
+    resolves any other key through its parent (another
+    :class:`~LayeredConfig` or a plain dictionary).
+
+    Project, sprite and image settings are chained this way, so every image
+    only pays for the settings it overrides instead of a full copy of the
+    configuration.
+    """
+
+    def __init__(self, parent=None, overrides=None):
+        self.parent = parent
+        self.overrides = dict(overrides or {})
+
+    def __getitem__(self, key):
+        try:
+            return self.overrides[key]
+        except KeyError:
+            if self.parent is None:
+                raise
+            return self.parent[key]
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __contains__(self, key):
+        return key in self.overrides or (self.parent is not None and key in self.parent)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '<LayeredConfig {0!r}>'.format(self.overrides)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        self.overrides.update(*args, **kwargs)
+
+    def keys(self):
+        keys = set(self.overrides)
+        if self.parent is not None:
+            keys.update(self.parent.keys())
+        return list(keys)
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        """Return a plain dictionary with the resolved configuration."""
+        return dict(self.iteritems())
+
+
+def makedirs(path):
+    """Create the directory at ``path`` (and its parents) unless it
+    already exists, even if another thread or process creates it first."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def file_signature(path):
+    """Return the size and modification time of the file at ``path`` or
+    ``None`` if it doesn't exist."""
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime
+
+
+def split_patterns(value):
+    """Return the list of glob patterns contained in a comma-separated
+    setting."""
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [p.strip() for p in value.split(',') if p.strip()]
+
+
+def match_patterns(name, relpath, patterns):
+    """Return ``True`` if either the ``name`` or the ``relpath`` (using ``/``
+    as separator) of a file or directory matches any of these glob
+    patterns."""
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern):
+            return True
+    return False
+
+
+def _list_directory(path):
+    """Return a list of ``(name, is_dir, is_link)`` tuples with the contents
+    of a directory. If ``scandir`` is available the file type returned by the
+    operating system while listing the directory is used instead of an extra
+    ``stat`` call per entry. Otherwise every entry is ``lstat``-ed once, and
+    only symbolic links need a second call to know what they point to."""
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        entry_path = os.path.join(path, name)
+        try:
+            mode = os.lstat(entry_path).st_mode
+        except OSError:
+            continue
+        is_link = stat.S_ISLNK(mode)
+        is_dir = os.path.isdir(entry_path) if is_link else stat.S_ISDIR(mode)
+        entries.append((name, is_dir, is_link))
+    return entries
+
+
+def walk_files(path, recursive=False, follow_links=False, include=(), exclude=()):
+    """Yield the path of every file inside ``path`` in a deterministic order:
+    files of a directory sorted by name first, and then the ones inside each
+    subdirectory (also sorted by name).
+
+    :param path: Directory to walk.
+    :param recursive: Walk subdirectories too.
+    :param follow_links: Walk symbolic links to directories.
+    :param include: Only yield files matching any of these glob patterns.
+    :param exclude: Ignore files and prune directories matching any of these
+                    glob patterns.
+    """
+    def walk(directory, prefix):
+        files, dirs = [], []
+        for name, is_dir, is_link in _list_directory(directory):
+            relpath = prefix + name
+            if match_patterns(name, relpath, exclude):
+                continue
+            if is_dir:
+                if recursive and (follow_links or not is_link):
+                    dirs.append(name)
+            elif not include or match_patterns(name, relpath, include):
+                files.append(name)
+
+        for name in sorted(files):
+            yield os.path.join(directory, name)
+
+        for name in sorted(dirs):
+            for filename in walk(os.path.join(directory, name), prefix + name + '/'):
+                yield filename
+
+    return walk(path, '')
+
+
+def walk_order(paths, root):
+    """Return ``paths`` sorted in the same order :func:`walk_files` would
+    yield them while walking ``root``."""
+    def key(path):
+        parts = os.path.relpath(path, root).split(os.sep)
+        return [(1, p) for p in parts[:-1]] + [(0, parts[-1])]
+    return sorted(paths, key=key)
+
+
+def common_directory(paths):
+    """Return the deepest directory containing all these absolute paths."""
+    common = []
+    for parts in zip(*[os.path.dirname(p).split(os.sep) for p in paths]):
+        if len(set(parts)) != 1:
+            break
+        common.append(parts[0])
+    return os.sep.join(common) or os.sep
+
+
 class _Missing(object):
     """ Missing object necessary for cached_property"""
     def __repr__(self):
@@ -63,6 +395,8 @@ class cached_property(object):
 @contextlib.contextmanager
 def redirect_stdout(stream=None):
     stream = stream or StringIO()
-    sys.stdout = stream
-    yield
-    sys.stdout = sys.__stdout__
+    previous, sys.stdout = sys.stdout, stream
+    try:
+        yield
+    finally:
+        sys.stdout = previous
@@ -0,0 +1,51 @@
+from array import array
+from operator import add
+
+
+class Layout(object):
+    """Layout of the images of a sprite stored as a table of columns.
+
+    Every column is an ``array`` with one item per row (image) except
+    ``padding`` and ``margin`` which contain four items per row (top, right,
+    bottom and left). Algorithms and formats read and write these columns
+    instead of the attributes of every :class:`~glue.core.Image`, which only
+    keep a reference to their row.
+    """
+
+    def __init__(self, images):
+        self.images = images
+
+        self.width = array('l')
+        self.height = array('l')
+        self.absolute_width = array('l')
+        self.absolute_height = array('l')
+        self.padding = array('l')
+        self.margin = array('l')
+
+        for row, image in enumerate(images):
+            self.width.append(image.width)
+            self.height.append(image.height)
+            self.absolute_width.append(image.absolute_width)
+            self.absolute_height.append(image.absolute_height)
+            self.padding.extend(image.padding)
+            self.margin.extend(image.margin)
+            image.layout, image.layout_index = self, row
+
+        self.x = array('l', [0]) * len(images)
+        self.y = array('l', [0]) * len(images)
+
+    def __len__(self):
+        return len(self.images)
+
+    def spacing(self, row):
+        """Return the padding and margin of a row as two 4-elements tuples."""
+        start = row * 4
+        return tuple(self.padding[start:start + 4]), tuple(self.margin[start:start + 4])
+
+    @property
+    def size(self):
+        """Return the width and height of the area used by all the rows."""
+        if not self.images:
+            return 0, 0
+        return (max(map(add, self.x, self.absolute_width)),
+                max(map(add, self.y, self.absolute_height)))
@@ -1,7 +1,15 @@
-import hashlib
+import sys
+import Queue
+import traceback
+import multiprocessing
+from StringIO import StringIO
 
+from glue import exceptions
 from glue.core import Sprite
+from glue.helpers import redirect_stdout
 from glue.formats import formats
+from glue.manifest import BuildManifest
+from glue.pipeline import pipeline
 
 
 class BaseManager(object):
@@ -9,20 +17,21 @@ class BaseManager(object):
     def __init__(self, *args, **kwargs):
         self.config = kwargs
         self.sprites = []
+        self.manifests = {}
 
     def process(self):
         self.find_sprites()
         self.validate()
         self.save()
 
-    def add_sprite(self, path):
+    def add_sprite(self, path, files=None):
         """Create a new Sprite using this path and name and append it to the
         sprites list.
 
         :param path: Sprite path.
-        :param name: Sprite name.
+        :param files: Optional list of source images of this sprite.
         """
-        sprite = Sprite(path=path, config=self.config)
+        sprite = Sprite(path=path, config=self.config, files=files)
         self.sprites.append(sprite)
 
     def find_sprites(self):
@@ -34,16 +43,210 @@ class BaseManager(object):
         for sprite in self.sprites:
             sprite.validate()
 
+    def manifest(self, path):
+        """Return the :class:`~glue.manifest.BuildManifest` of the output
+        directory at ``path``."""
+        if path not in self.manifests:
+            self.manifests[path] = BuildManifest(path)
+        return self.manifests[path]
+
+    def sprite_formats(self, sprite):
+        """Return a list with the name and an instance of every enabled
+        format for ``sprite``."""
+        sprite_formats = []
+        for format_name in self.config['enabled_formats']:
+            format = formats[format_name](sprite=sprite)
+            format.manifest = self.manifest(format.output_dir())
+            sprite_formats.append((format_name, format))
+        return sprite_formats
+
     def save(self):
         """Save all sprites inside this manager."""
+        jobs = int(self.config.get('jobs') or 1)
+        try:
+            if jobs > 1 and len(self.sprites) > 1:
+                self._save_sprites_in_parallel(jobs)
+            else:
+                for sprite in self.sprites:
+                    self.save_sprite(sprite)
+        finally:
+            for manifest in self.manifests.values():
+                manifest.save()
 
-        for format_name in self.config['enabled_formats']:
-            format_cls = formats[format_name]
-            for sprite in self.sprites:
-                format = format_cls(sprite=sprite)
-                format.validate()
-                if format.needs_rebuild() or sprite.config['force']:
-                    print "Format '{0}' for sprite '{1}' needs rebuild...".format(format_name, sprite.name)
-                    format.build()
-                else:
+    def save_sprite(self, sprite):
+        """Build every enabled format of ``sprite`` that needs it.
+
+        Formats are checked one by one, but the ones that need to be built
+        are built at the same time using one thread each, sharing the
+        layout of the sprite. Text rendering, PNG encoding and zlib don't
+        hold the GIL, so they really overlap. The log is always the same
+        and if several formats fail, the error of the first one (in the
+        enabled formats order) is raised.
+        """
+        builds = []
+        for format_name, format in self.sprite_formats(sprite):
+            # Sprites are only processed if some format isn't fresh.
+            if not sprite.config['force'] and format.is_fresh():
+                print "Format '{0}'' for sprite '{1}' already exists...".format(format_name, sprite.name)
+                continue
+
+            format.validate()
+            if format.needs_rebuild() or sprite.config['force']:
+                print "Format '{0}' for sprite '{1}' needs rebuild...".format(format_name, sprite.name)
+                builds.append(format)
+            else:
+                print "Format '{0}'' for sprite '{1}' already exists...".format(format_name, sprite.name)
+                format.record()
+
+        if builds:
+            # Process the sprite before the threads need it.
+            sprite.canvas_size
+
+            def build(format):
+                format.build()
+                return format
+
+            for format in pipeline(build, builds, threads=len(builds)):
+                format.record()
+
+        sprite.save_index()
+
+    def _save_sprites_in_parallel(self, jobs):
+        """Build the sprites using up to ``jobs`` worker processes at once,
+        one for each sprite.
+
+        The most expensive sprites (using the number of pixels of their
+        source images as estimate) are started first so none of them is
+        left running alone at the end. If ``max_memory`` is set, sprites
+        are only started while the estimated memory of the running ones
+        fits in it (but at least one is always running).
+
+        Every sprite folder is only walked (and its images stat-ed) here:
+        workers receive the list of source images and the fingerprint of
+        the sprite instead of finding them again.
+
+        The log of every sprite is printed in the same order as building
+        them one by one, and if several sprites fail, the error of the
+        first one is raised. A worker that dies without sending its result
+        fails its sprite with :class:`~glue.exceptions.SpriteWorkerError`.
+        """
+        pending = []
+        for index, sprite in enumerate(self.sprites):
+            if sprite.files is None:
+                sprite.files = list(sprite.source_paths())
+            if sprite.config['force'] or not all(f.is_fresh() for _, f in self.sprite_formats(sprite)):
+                pending.append((sprite.estimated_pixels() * BYTES_PER_PIXEL, index, sprite))
+        pending.sort(key=lambda task: (-task[0], task[1]))
+
+        max_memory = self.config.get('max_memory')
+        max_memory = max_memory * 1024 * 1024 if max_memory else None
+
+        config = dict(self.config, jobs=1)
+        results = {}
+        running = {}
+        memory = 0
+        finished = multiprocessing.Queue()
+
+        try:
+            while pending or running:
+                while pending and len(running) < jobs:
+                    task = next((t for t in pending if not running or max_memory is None or
+                                 memory + t[0] <= max_memory), None)
+                    if task is None:
+                        break
+                    pending.remove(task)
+                    cost, index, sprite = task
+                    args = (config, sprite.path, sprite.files, sprite.fingerprint)
+                    process = multiprocessing.Process(target=_save_sprite_process,
+                                                      args=(finished, index, args))
+                    process.start()
+                    running[index] = (cost, process)
+                    memory += cost
+
+                try:
+                    done = [finished.get(timeout=WORKER_TIMEOUT)]
+                except Queue.Empty:
+                    # A worker killed (e.g. by the OOM killer) never sends
+                    # its result. Workers send it before exiting, so the
+                    # result of any worker already exited is in the queue.
+                    exited = [i for i, (_, p) in running.iteritems() if p.exitcode is not None]
+                    done = []
+                    try:
+                        while True:
+                            done.append(finished.get_nowait())
+                    except Queue.Empty:
+                        pass
+                    received = set(index for index, _ in done)
+                    for index in exited:
+                        if index not in received:
+                            exitcode = running[index][1].exitcode
+                            message = "The worker building sprite '{0}' exited unexpectedly " \
+                                      "(exit code {1}).".format(self.sprites[index].name, exitcode)
+                            done.append((index, ('', {}, (None, message))))
+
+                for index, result in done:
+                    results[index] = result
+                    cost, process = running.pop(index)
+                    memory -= cost
+                    process.join()
+        finally:
+            for _, process in running.itervalues():
+                process.terminate()
+                process.join()
+
+        for index, sprite in enumerate(self.sprites):
+            if index not in results:
+                for format_name, _ in self.sprite_formats(sprite):
                     print "Format '{0}'' for sprite '{1}' already exists...".format(format_name, sprite.name)
+                continue
+
+            log, updates, error = results[index]
+            sys.stdout.write(log)
+            for path, manifest_updates in updates.iteritems():
+                self.manifest(path).update(manifest_updates)
+            if error is not None:
+                error_name, value = error
+                if error_name is None:
+                    raise exceptions.SpriteWorkerError(value)
+                raise getattr(exceptions, error_name)(*value)
+
+
+# Estimated memory needed to build a sprite for every source pixel: the
+# decoded source image and its area of the canvas (both RGBA).
+BYTES_PER_PIXEL = 8
+
+# Seconds to wait for any sprite worker to finish before checking if some
+# of them died.
+WORKER_TIMEOUT = 0.5
+
+
+def _save_sprite_worker(args):
+    """Build the sprite at ``path`` inside a worker process.
+
+    Return the log of the build, the build manifest entries it recorded and
+    the error raised building it, if any. Errors are returned as the name
+    and arguments of glue errors, or the formatted traceback of any other
+    exception, so nothing unpicklable crosses the process boundary.
+    """
+    config, path, files, fingerprint = args
+    manager = BaseManager(**config)
+    log = StringIO()
+    error = None
+    with redirect_stdout(log):
+        try:
+            manager.add_sprite(path=path, files=files)
+            sprite = manager.sprites[0]
+            sprite.fingerprint = fingerprint
+            manager.save_sprite(sprite)
+        except exceptions.GlueError, e:
+            error = (e.__class__.__name__, e.args)
+        except Exception:
+            error = (None, traceback.format_exc())
+    updates = dict((manifest.path, manifest.updates) for manifest in manager.manifests.values())
+    return log.getvalue(), updates, error
+
+
+def _save_sprite_process(finished, index, args):
+    """Build a sprite inside its own worker process and put its result in
+    the ``finished`` queue along with the ``index`` of the sprite."""
+    finished.put((index, _save_sprite_worker(args)))
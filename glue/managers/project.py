@@ -1,6 +1,7 @@
 import os
 
 from glue.exceptions import NoSpritesFoldersFoundError
+from glue.helpers import match_patterns, split_patterns
 from .base import BaseManager
 from glue.core import ProjectConfig
 
@@ -14,13 +15,15 @@ class ProjectManager(BaseManager):
 
         self.config.update( ProjectConfig(self.config['source']).items() )
 
+        exclude = split_patterns(self.config.get('exclude'))
+
         for filename in sorted(os.listdir(self.config['source'])):
 
             # Only process folders
             path = os.path.join(self.config['source'], filename)
 
-            # Ignore filenames starting with '.'
-            if filename.startswith('.'):
+            # Ignore filenames starting with '.' or excluded ones
+            if filename.startswith('.') or match_patterns(filename, filename, exclude):
                 continue
 
             # Ignore symlinks if necessary.
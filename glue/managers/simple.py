@@ -9,5 +9,5 @@ class SimpleManager(BaseManager):
     """
 
     def find_sprites(self):
-        self.add_sprite(path=self.config['source'])
+        self.add_sprite(path=self.config['source'], files=self.config.get('files'))
 
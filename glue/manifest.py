@@ -0,0 +1,123 @@
+import os
+import json
+
+from glue.cache import atomic_write
+
+
+class BuildManifest(object):
+    """Record of the files glue built inside an output directory.
+
+    For every format of every sprite the manifest contains the hash the
+    files were built with and the size and modification time of each of
+    them, so knowing if they are up to date only needs a few ``os.stat``
+    calls instead of opening and parsing every previous output.
+    """
+
+    filename = '.glue-manifest'
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.changed = False
+        # Entries recorded (or discarded, using None) by this build.
+        self.updates = {}
+        try:
+            with open(os.path.join(self.path, self.filename)) as f:
+                data = json.load(f)
+            assert data['version'] == self.version
+            self.entries = data['entries']
+        except Exception:
+            self.entries = {}
+
+    def get(self, key, hash, paths):
+        """Return ``True`` if the files recorded for ``key`` are ``paths``,
+        were built using ``hash`` and none of them changed since, ``False``
+        if they are outdated and ``None`` if the manifest knows nothing
+        about them.
+
+        :param key: Key of the format and sprite the files belong to.
+        :param hash: Current hash of the format.
+        :param paths: Paths of the files the format builds now.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return (entry['hash'] == hash and self._same_outputs(entry, paths)
+                and self._unchanged(entry))
+
+    def fresh(self, key, fingerprint, paths=None):
+        """Return ``True`` if the files recorded for ``key`` were built
+        from a sprite with this fingerprint and none of them changed since.
+
+        :param key: Key of the format and sprite the files belong to.
+        :param fingerprint: Current fingerprint of the sprite.
+        :param paths: Paths of the files the format builds now, if they are
+                      known without processing the sprite.
+        """
+        entry = self.entries.get(key)
+        return (entry is not None and entry.get('fingerprint') == fingerprint
+                and (paths is None or self._same_outputs(entry, paths))
+                and self._unchanged(entry))
+
+    def _same_outputs(self, entry, paths):
+        names = set(os.path.relpath(path, self.path) for path in paths)
+        return names == set(entry['outputs'])
+
+    def _unchanged(self, entry):
+        for name, (size, mtime) in entry['outputs'].iteritems():
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime != mtime:
+                return False
+        return True
+
+    def record(self, key, hash, paths, fingerprint=None):
+        """Record that ``paths`` were built using ``hash``. Missing files
+        are not recorded, so they will be built again.
+
+        :param key: Key of the format and sprite these files belong to.
+        :param hash: Hash of the format used to build them.
+        :param paths: Paths of the built files.
+        :param fingerprint: Fingerprint of the sprite they were built from.
+        """
+        outputs = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.discard(key)
+                return
+            outputs[os.path.relpath(path, self.path)] = [stat.st_size, stat.st_mtime]
+
+        entry = {'hash': hash, 'outputs': outputs, 'fingerprint': fingerprint}
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.updates[key] = entry
+            self.changed = True
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.updates[key] = None
+            self.changed = True
+
+    def update(self, updates):
+        """Apply the ``updates`` recorded by another manifest of the same
+        directory (e.g. by a worker process)."""
+        for key, entry in updates.iteritems():
+            if entry is None:
+                self.discard(key)
+            elif self.entries.get(key) != entry:
+                self.entries[key] = self.updates[key] = entry
+                self.changed = True
+
+    def save(self):
+        """Save the manifest if any entry changed."""
+        if not self.changed or not os.path.isdir(self.path):
+            return
+
+        with atomic_write(os.path.join(self.path, self.filename)) as f:
+            json.dump({'version': self.version, 'entries': self.entries}, f,
+                      sort_keys=True)
+        self.changed = False
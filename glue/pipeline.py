@@ -0,0 +1,102 @@
+import sys
+import Queue
+import threading
+
+
+# Number of threads of every stage and how many items each stage can
+# process ahead of the next one.
+THREADS = 4
+BUFFER_SIZE = THREADS * 2
+
+_end = object()
+
+
+def pipeline(func, iterable, threads=THREADS, buffer_size=BUFFER_SIZE):
+    """Yield ``func(item)`` for every item of ``iterable`` in the same order.
+
+    Items are consumed from ``iterable`` in a background thread and
+    ``func`` is called for several of them at the same time using
+    ``threads`` threads, so reading, hashing and decoding (which don't hold
+    the GIL) of the next items overlap with whatever the caller does with
+    the previous ones. At most ``buffer_size`` items are consumed ahead of
+    the caller, so memory usage is bounded no matter how many items there
+    are.
+
+    Any error raised by ``iterable`` or ``func`` is raised by this
+    generator when the caller reaches the item that raised it.
+
+    :param func: Function to apply to every item.
+    :param iterable: Items to process.
+    :param threads: Number of threads calling ``func``.
+    :param buffer_size: Number of items that can be processed ahead.
+    """
+    if threads < 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    slots = threading.Semaphore(buffer_size)
+    tasks = Queue.Queue()
+    results = {}
+    ready = threading.Condition()
+    stopped = threading.Event()
+
+    def publish(index, result):
+        with ready:
+            results[index] = result
+            ready.notify()
+
+    def feed():
+        index = 0
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                tasks.put((index, item))
+                index += 1
+            else:
+                publish(index, (_end, None))
+        except Exception:
+            publish(index, (False, sys.exc_info()))
+        finally:
+            for _ in xrange(threads):
+                tasks.put(None)
+
+    def work():
+        for index, item in iter(tasks.get, None):
+            if stopped.is_set():
+                continue
+            try:
+                publish(index, (True, func(item)))
+            except Exception:
+                publish(index, (False, sys.exc_info()))
+
+    workers = [threading.Thread(target=feed)]
+    workers.extend(threading.Thread(target=work) for _ in xrange(threads))
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    try:
+        index = 0
+        while True:
+            with ready:
+                while index not in results:
+                    ready.wait()
+                success, value = results.pop(index)
+
+            if success is _end:
+                return
+            if not success:
+                raise value[0], value[1], value[2]
+
+            slots.release()
+            yield value
+            index += 1
+    finally:
+        stopped.set()
+        for _ in xrange(buffer_size):
+            slots.release()
+        for worker in workers:
+            worker.join()
@@ -19,7 +19,8 @@ setup(
     install_requires=[
         'Pillow>=2.2.2',
         'Jinja2>=2.7,<2.8',
-        'argparse>=1.1'
+        'argparse>=1.1',
+        'scandir>=1.5'
     ],
     tests_require=[
         'cssutils>=0.9,<1.0',
@@ -2,9 +2,14 @@ import os
 import sys
 import json
 import codecs
+import random
 import shutil
+import hashlib
 import unittest
+import signal
 import logging
+import threading
+import ConfigParser
 from StringIO import StringIO
 from plistlib import readPlist
 
@@ -12,9 +17,15 @@ from PIL import Image as PILImage
 import cssutils
 from mock import patch, Mock
 
+from glue import __version__
 from glue.bin import main
 from glue.core import Image
-from glue.helpers import redirect_stdout
+from glue.exceptions import ValidationError
+from glue.layout import Layout
+from glue.managers.base import BaseManager
+from glue.pipeline import pipeline
+from glue.algorithms import VerticalAlgorithm, MaxRectsAlgorithm, SquareAlgorithm
+from glue.helpers import redirect_stdout, image_size, png_text, walk_files, _list_directory
 
 
 RED = (255, 0, 0, 255)
@@ -461,6 +472,99 @@ class TestGlue(unittest.TestCase):
                         u'width': u'16px',
                         u'height': u'16px'})
 
+    def test_algorithm_maxrects(self):
+        self.create_image("simple/red.png", RED, (64, 64))
+        self.create_image("simple/blue.png", BLUE, (32, 32))
+        self.create_image("simple/yellow.png", YELLOW, (16, 16))
+        code = self.call("glue simple output --algorithm=maxrects")
+        self.assertEqual(code, 0)
+
+        self.assertExists("output/simple.png")
+        self.assertExists("output/simple.css")
+        self.assertEqual(PILImage.open("output/simple.png").size, (64, 112))
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", BLUE, ((0, 64), (31, 95)))
+        self.assertColor("output/simple.png", YELLOW, ((0, 96), (15, 111)))
+
+        self.assertCSS(u"output/simple.css", u'.sprite-simple-yellow',
+                       {u'background-image': u"url(simple.png)",
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'0 -96px',
+                        u'width': u'16px',
+                        u'height': u'16px'})
+
+        # The algorithm and its heuristic can be configured per sprite.
+        shutil.rmtree("output")
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[sprite]\nalgorithm=maxrects\nmaxrects_heuristic=bottom-left\n")
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("output/simple.png").size, (64, 96))
+        self.assertColor("output/simple.png", BLUE, ((0, 64), (31, 95)))
+        self.assertColor("output/simple.png", YELLOW, ((32, 64), (47, 79)))
+
+    def test_algorithm_maxrects_invalid_heuristic(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[sprite]\nalgorithm=maxrects\nmaxrects_heuristic=best-shortside\n")
+
+        code = self.call("glue simple output")
+        self.assertEqual(code, 3)
+        self.assertTrue("Invalid maxrects_heuristic 'best-shortside'" in sys.stderr.getvalue())
+        self.assertDoesNotExists("output/simple.png")
+
+    def test_algorithm_maxrects_heuristics(self):
+        config = {'crop': False, 'margin': '0', 'padding': '0', 'ratios': [1.0]}
+        sizes = [(48, 40), (40, 32), (35, 31), (30, 24), (24, 30), (20, 20),
+                 (17, 9), (16, 16), (9, 15), (8, 8), (5, 12), (3, 3)]
+        images = [Image(path=self.create_image("simple/{0}.png".format(i), RED, size=size), config=config)
+                  for i, size in enumerate(sizes)]
+
+        for heuristic in MaxRectsAlgorithm.heuristics:
+            layout = Layout(images)
+            MaxRectsAlgorithm().process(Mock(layout=layout, config={'maxrects_heuristic': heuristic}))
+
+            rects = zip(layout.x, layout.y, layout.absolute_width, layout.absolute_height)
+            for i, (x, y, width, height) in enumerate(rects):
+                for other_x, other_y, other_width, other_height in rects[i + 1:]:
+                    self.assertFalse(x < other_x + other_width and other_x < x + width and
+                                     y < other_y + other_height and other_y < y + height,
+                                     heuristic)
+
+            # The bin is as wide as the square root of the area of all the images.
+            self.assertTrue(layout.size[0] <= 83, heuristic)
+
+    def test_algorithm_maxrects_scale(self):
+        generator = random.Random(0)
+        sizes = sorted([(generator.randint(8, 64), generator.randint(8, 64)) for i in xrange(5000)],
+                       key=lambda size: -max(size))
+        images = [Mock(width=w, height=h, absolute_width=w, absolute_height=h,
+                       padding=(0, 0, 0, 0), margin=(0, 0, 0, 0)) for w, h in sizes]
+
+        for heuristic, (score, bound) in MaxRectsAlgorithm.heuristics.items():
+            scored = []
+
+            def counting_score(rect, width, height):
+                scored.append(rect)
+                return score(rect, width, height)
+
+            layout = Layout(images)
+            with patch.dict(MaxRectsAlgorithm.heuristics,
+                            {heuristic: (score and counting_score, bound)}):
+                MaxRectsAlgorithm().process(Mock(layout=layout, config={'maxrects_heuristic': heuristic}))
+
+            # No image overlaps another one.
+            canvas = PILImage.new('L', layout.size, 0)
+            for x, y, width, height in zip(layout.x, layout.y, layout.absolute_width, layout.absolute_height):
+                canvas.paste(255, (x, y, x + width, y + height))
+            self.assertEqual(canvas.histogram()[255], sum(w * h for w, h in sizes), heuristic)
+
+            # Finding where every image goes with the default heuristic
+            # only looks at a few of the free rectangles where it fits.
+            if heuristic == 'best-short-side':
+                self.assertTrue(len(scored) < 30 * len(sizes))
+
     def test_no_img_with_img(self):
         self.create_image("simple/red.png", RED)
         self.create_image("simple/blue.png", BLUE)
@@ -1725,5 +1829,686 @@ class TestGlue(unittest.TestCase):
             data = json.loads(f.read())
             assert isinstance(data['sprites'], dict)
 
+    def test_jobs(self):
+        self.create_image("simple/red.png", RED, margin=4)
+        self.create_image("simple/blue.png", BLUE, size=(32, 48))
+        self.create_image("simple/green.png", GREEN, size=(16, 16), margin=2)
+        self.create_image("simple/yellow.png", YELLOW, size=(8, 24))
+
+        code = self.call("glue simple serial --crop")
+        self.assertEqual(code, 0)
+        code = self.call("glue simple parallel --crop --jobs=2")
+        self.assertEqual(code, 0)
+
+        serial = PILImage.open("serial/simple.png")
+        parallel = PILImage.open("parallel/simple.png")
+        self.assertEqual(serial.size, parallel.size)
+        self.assertEqual(serial.tobytes(), parallel.tobytes())
+
+        # Skip the first line as it contains the hash of the sprite.
+        with open("serial/simple.css") as serial:
+            with open("parallel/simple.css") as parallel:
+                self.assertEqual(serial.readlines()[1:], parallel.readlines()[1:])
+
+        # Checking if the sprite is up to date doesn't decode any image.
+        with patch('glue.core.Sprite._decode_images') as mocked_decode:
+            code, out = self.call("glue simple parallel --crop --jobs=2", capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_decode.called)
+        self.assertFalse("needs rebuild" in out)
+
+        with self.assertRaises(SystemExit):
+            self.call("glue simple output --jobs=0")
+
+    def test_image_size(self):
+        for extension in ('png', 'jpg', 'gif'):
+            path = self.create_image("simple/red.{0}".format(extension), RED, size=(48, 20))
+            with open(path, 'rb') as f:
+                self.assertEqual(image_size(f), (48, 20))
+
+        self.assertEqual(image_size(StringIO("not an image")), None)
+
+    def test_image_source_is_not_kept_in_memory(self):
+        path = self.create_image("simple/red.png", RED)
+        image = Image(path=path, config={'crop': False, 'padding': '0', 'margin': '0'})
+        self.assertFalse(hasattr(image, '_image_data'))
+
+        with open(path, 'rb') as f:
+            self.assertEqual(image.digest, hashlib.sha1(f.read()).hexdigest())
+        self.assertEqual(image.image.size, (64, 64))
+        self.assertEqual(image.image.getpixel((0, 0)), RED)
+
+    def test_cache(self):
+        self.create_image("simple/red.png", RED, margin=4)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --crop --cache=cache")
+        self.assertEqual(code, 0)
+
+        entries = [f for root, dirs, files in os.walk("cache")
+                   for f in files if root != os.path.join("cache", "index")]
+        self.assertEqual(len(entries), 2)
+
+        # Second build must only use the cached images.
+        with patch('glue.core.decode_image') as mocked_decode:
+            code = self.call("glue simple output --crop --cache=cache --force")
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_decode.called)
+
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", BLUE, ((64, 0), (127, 63)))
+
+    def test_cache_index(self):
+        self.create_image("simple/red.png", RED, margin=4)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --crop --cache=cache")
+        self.assertEqual(code, 0)
+
+        # Unchanged images are not opened at all.
+        with patch('glue.core.mapped_file') as mocked_mapped_file:
+            code, out = self.call("glue simple output --crop --cache=cache", capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_mapped_file.called)
+        self.assertTrue("already exists" in out)
+        self.assertFalse("needs rebuild" in out)
+
+        self.create_image("simple/blue.png", GREEN)
+        code, out = self.call("glue simple output --crop --cache=cache", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("needs rebuild" in out)
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", GREEN, ((64, 0), (127, 63)))
+
+    def test_cache_unwritable(self):
+        self.create_image("simple/red.png", RED, margin=4)
+        self.create_image("simple/blue.png", BLUE)
+
+        # A file where the cache directory should be makes every write fail.
+        with open("cache", "w") as f:
+            f.write("")
+
+        code = self.call("glue simple output --crop --cache=cache")
+        self.assertEqual(code, 0)
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", BLUE, ((64, 0), (127, 63)))
+
+    def test_grayscale_transparency(self):
+        os.mkdir("simple")
+        image = PILImage.new('L', (64, 64), 0)
+        image.paste(200, (32, 0, 64, 64))
+        image.save("simple/gray.png", transparency=0)
+        self.create_image("simple/red.png", RED)
+
+        code = self.call("glue simple output --crop")
+        self.assertEqual(code, 0)
+
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", (200, 200, 200, 255), ((64, 0), (95, 63)))
+        self.assertCSS(u"output/simple.css", u'.sprite-simple-gray',
+                       {u'background-image': u"url(simple.png)",
+                        u'background-repeat': u'no-repeat',
+                        u'background-position': u'-64px 0',
+                        u'width': u'32px',
+                        u'height': u'64px'})
+
+    def test_config_files_are_parsed_once(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        self.create_image("simple/green.png", GREEN)
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[sprite]\npadding=2\n[blue.png]\nmargin=4\n")
+
+        read = ConfigParser.RawConfigParser.read
+        with patch('ConfigParser.RawConfigParser.read', autospec=True, side_effect=read) as mocked_read:
+            code = self.call("glue simple output")
+            self.assertEqual(code, 0)
+            self.assertEqual(mocked_read.call_count, 1)
+
+        self.assertColor("output/simple.png", BLUE, ((6, 6), (69, 69)))
+
+    def test_image_config_only_stores_overrides(self):
+        self.create_image("simple/red.png", RED)
+        path = self.create_image("simple/blue.png", BLUE)
+        with open('simple/sprite.conf', 'w') as f:
+            f.write("[blue.png]\nmargin=4\n")
+
+        config = {'crop': False, 'margin': '0', 'padding': '0'}
+        image = Image(path=path, config=config)
+        self.assertEqual(image.config.overrides, {'margin': '4'})
+        self.assertEqual(image.config['margin'], '4')
+        self.assertEqual(image.config['padding'], '0')
+
+        config['padding'] = '2'
+        self.assertEqual(image.config['padding'], '2')
+        self.assertEqual(config['margin'], '0')
+
+    def test_layout(self):
+        config = {'crop': False, 'margin': '0', 'padding': '1 2', 'ratios': [1.0]}
+        images = [Image(path=self.create_image("simple/red.png", RED), config=config),
+                  Image(path=self.create_image("simple/blue.png", BLUE, size=(32, 16)), config=config)]
+        layout = Layout(images)
+
+        self.assertEqual(list(layout.width), [64, 32])
+        self.assertEqual(list(layout.absolute_height), [66, 18])
+        self.assertEqual(layout.spacing(1), ((1, 2, 1, 2), (0, 0, 0, 0)))
+        self.assertEqual(images[1].layout_index, 1)
+
+        VerticalAlgorithm().process(Mock(layout=layout))
+        self.assertEqual(list(layout.y), [0, 66])
+        self.assertEqual((images[1].x, images[1].y), (0, 66))
+        self.assertEqual(layout.size, (68, 84))
+
+    def test_algorithm_square_layout(self):
+        config = {'crop': False, 'margin': '0', 'padding': '0', 'ratios': [1.0]}
+        sizes = [(64, 20), (48, 48), (20, 48), (40, 32), (35, 31), (30, 24), (24, 30), (20, 20),
+                 (17, 9), (16, 16), (16, 16), (9, 15), (8, 8), (5, 12), (3, 3), (1, 1)]
+        images = [Image(path=self.create_image("simple/{0}.png".format(i), RED, size=size), config=config)
+                  for i, size in enumerate(sizes)]
+        layout = Layout(images)
+        SquareAlgorithm().process(Mock(layout=layout))
+
+        # Coordinates calculated by the previous recursive implementation.
+        self.assertEqual(zip(layout.x, layout.y),
+                         [(0, 0), (0, 20), (64, 0), (84, 0), (84, 32), (0, 68), (0, 92), (64, 48),
+                          (30, 68), (48, 20), (48, 36), (48, 52), (47, 68), (119, 32), (119, 44), (122, 44)])
+        self.assertEqual(layout.size, (124, 122))
+
+    def test_invalid_spacing(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+
+        for option in ("--padding=a", "--padding=1,2,3,4,5", "--margin=-1", "--margin=,"):
+            code, out = self.call("glue simple output {0}".format(option), capture=True)
+            self.assertEqual(code, 3)
+            self.assertDoesNotExists("output/simple.png")
+
+        code = self.call("glue simple output --padding=1,2")
+        self.assertEqual(code, 0)
+
+    def test_stream(self):
+        self.create_image("simple/red.png", RED, margin=4)
+        self.create_image("simple/blue.png", BLUE, size=(32, 48))
+        self.create_image("simple/green.png", GREEN, size=(16, 16))
+
+        code = self.call("glue simple default --crop")
+        self.assertEqual(code, 0)
+
+        release = Image.release
+        with patch('glue.core.Image.release', autospec=True, side_effect=release) as mocked_release:
+            code = self.call("glue simple stream --crop --stream")
+            self.assertEqual(code, 0)
+            released = [call[0][0].filename for call in mocked_release.call_args_list]
+
+        # Images are released after finding their crop box and after pasting them.
+        self.assertEqual(sorted(released), sorted(['red.png', 'blue.png', 'green.png'] * 2))
+
+        default = PILImage.open("default/simple.png")
+        stream = PILImage.open("stream/simple.png")
+        self.assertEqual(default.tobytes(), stream.tobytes())
+
+    def test_deduplicate(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        shutil.copy("simple/red.png", "simple/alias.png")
+
+        code, out = self.call("glue simple output --deduplicate --css --json", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("1 duplicated images packed only once (4096 pixels" in out)
+
+        self.assertEqual(PILImage.open("output/simple.png").size, (128, 64))
+        self.assertColor("output/simple.png", RED, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", BLUE, ((64, 0), (127, 63)))
+
+        for name in ('red', 'alias'):
+            self.assertCSS(u"output/simple.css", u'.sprite-simple-{0}'.format(name),
+                           {u'background-image': u"url(simple.png)",
+                            u'background-repeat': u'no-repeat',
+                            u'background-position': u'0 0',
+                            u'width': u'64px',
+                            u'height': u'64px'})
+
+        with codecs.open('output/simple.json', 'r', 'utf-8-sig') as f:
+            frames = dict((f['filename'], f['frame']) for f in json.loads(f.read())['frames'])
+        self.assertEqual(frames['alias.png'], frames['red.png'])
+
+        code = self.call("glue simple output --force")
+        self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("output/simple.png").size, (128, 128))
+
+    def test_include_exclude(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/red.jpg", RED)
+        self.create_image("simple/sub/blue.png", BLUE)
+        self.create_image("simple/node_modules/pkg/green.png", GREEN)
+        self.create_image("simple/raw/yellow.png", YELLOW)
+
+        code = self.call("glue simple output --recursive --exclude=node_modules,raw --include=*.png")
+        self.assertEqual(code, 0)
+
+        self.assertEqual(PILImage.open("output/simple.png").size, (128, 64))
+        self.assertColor("output/simple.png", BLUE, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", RED, ((64, 0), (127, 63)))
+
+        code = self.call("glue simple output --recursive --exclude=sub/*.png,*.jpg --force")
+        self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("output/simple.png").size, (128, 128))
+
+    def test_walk_without_scandir(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/sub/blue.png", BLUE)
+        self.create_image("other/green.png", GREEN)
+        os.symlink(os.path.abspath("other"), "simple/link")
+
+        expected = list(walk_files("simple", recursive=True))
+        with patch('glue.helpers.scandir', None):
+            self.assertEqual(list(walk_files("simple", recursive=True)), expected)
+            self.assertEqual(list(walk_files("simple", recursive=True, follow_links=True)),
+                             [os.path.join("simple", "red.png"),
+                              os.path.join("simple", "link", "green.png"),
+                              os.path.join("simple", "sub", "blue.png")])
+        self.assertEqual(expected, [os.path.join("simple", "red.png"),
+                                    os.path.join("simple", "sub", "blue.png")])
+
+    def test_file_list(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/sub/blue.png", BLUE)
+        self.create_image("simple/stray.png", GREEN)
+        with open("files.txt", "w") as f:
+            f.write("simple/sub/blue.png\n\nsimple/red.png\n")
+
+        with patch('glue.helpers._list_directory') as mocked_list:
+            code = self.call("glue --file-list=files.txt output")
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_list.called)
+
+        self.assertExists("output/simple.png")
+        self.assertExists("output/simple.css")
+        self.assertEqual(PILImage.open("output/simple.png").size, (128, 64))
+        self.assertColor("output/simple.png", BLUE, ((0, 0), (63, 63)))
+        self.assertColor("output/simple.png", RED, ((64, 0), (127, 63)))
+
+        with patch('sys.stdin', StringIO("simple/stray.png\n")):
+            code = self.call("glue simple other --file-list=-")
+            self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("other/simple.png").size, (64, 64))
+        self.assertColor("other/simple.png", GREEN, ((0, 0), (63, 63)))
+
+        with self.assertRaises(SystemExit):
+            self.call("glue --file-list=missing.txt output")
+
+    def test_hash_does_not_read_unchanged_images(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+        with open("output/simple.png", "rb") as f:
+            sprite = f.read()
+
+        # Unchanged images are neither hashed nor decoded again.
+        with patch('glue.core.mapped_sha1') as mocked_sha1:
+            with patch('glue.core.decode_image') as mocked_decode:
+                code, out = self.call("glue simple output", capture=True)
+                self.assertEqual(code, 0)
+                self.assertFalse(mocked_sha1.called)
+                self.assertFalse(mocked_decode.called)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in out)
+        with open("output/simple.png", "rb") as f:
+            self.assertEqual(f.read(), sprite)
+
+        # Changed images are detected.
+        self.create_image("simple/blue.png", GREEN, size=(32, 32))
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+        self.assertColor("output/simple.png", GREEN, ((64, 0), (95, 31)))
+
+    def test_format_hashes(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --css --json")
+        self.assertEqual(code, 0)
+
+        # Text-only settings don't rebuild the sprite image.
+        code, out = self.call("glue simple output --css --json --separator=_ "
+                              "--namespace=icon", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in out)
+        self.assertTrue("Format 'css' for sprite 'simple' needs rebuild" in out)
+        self.assertTrue("Format 'json'' for sprite 'simple' already exists" in out)
+        with open("output/simple.css") as f:
+            self.assertTrue(".icon_simple_red" in f.read())
+
+        code, out = self.call("glue simple output --css --json --css --json-format=hash "
+                              "--separator=_ --namespace=icon", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in out)
+        self.assertTrue("Format 'css'' for sprite 'simple' already exists" in out)
+        self.assertTrue("Format 'json' for sprite 'simple' needs rebuild" in out)
+
+        # Neither does running glue from another directory.
+        os.chdir("simple")
+        code, out = self.call("glue . ../output --name=simple --css --json "
+                              "--css --json-format=hash --separator=_ "
+                              "--namespace=icon", capture=True)
+        os.chdir("..")
+        self.assertEqual(code, 0)
+        self.assertFalse("needs rebuild" in out)
+
+        # Settings changing the image rebuild every format.
+        code, out = self.call("glue simple output --css --json --css --json-format=hash "
+                              "--separator=_ --namespace=icon --padding=2",
+                              capture=True)
+        self.assertEqual(code, 0)
+        self.assertFalse("already exists" in out)
+
+        # So does a new version of glue.
+        with patch('glue.core.__version__', '99.0'):
+            code, out = self.call("glue simple output --css --json --css --json-format=hash "
+                                  "--separator=_ --namespace=icon --padding=2",
+                                  capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img' for sprite 'simple' needs rebuild" in out)
+
+    def test_manifest(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+        code = self.call("glue simple output --css --html --json --retina")
+        self.assertEqual(code, 0)
+        self.assertExists("output/.glue-manifest")
+
+        with open("output/.glue-manifest") as f:
+            manifest = json.loads(f.read())
+        self.assertEqual(sorted(manifest['entries'].keys()),
+                         [u'css:simple', u'html:simple', u'img:simple', u'json:simple'])
+        self.assertEqual(sorted(manifest['entries']['img:simple']['outputs'].keys()),
+                         [u'simple.png', u'simple@2x.png'])
+
+        # Up-to-date checks don't open any previous output.
+        with patch('glue.formats.img.PILImage.open') as mocked_open:
+            with patch('glue.formats.base.codecs.open') as mocked_codecs:
+                code, out = self.call("glue simple output --css --html --json --retina",
+                                      capture=True)
+                self.assertEqual(code, 0)
+                self.assertFalse(mocked_open.called)
+                self.assertFalse(mocked_codecs.called)
+        self.assertFalse("needs rebuild" in out)
+
+        # Outputs modified or removed outside glue are built again.
+        with open("output/simple.css", "a") as f:
+            f.write("/* edited */")
+        os.remove("output/simple@2x.png")
+        code, out = self.call("glue simple output --css --html --json --retina",
+                              capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'css' for sprite 'simple' needs rebuild" in out)
+        self.assertTrue("Format 'img' for sprite 'simple' needs rebuild" in out)
+        self.assertTrue("Format 'json'' for sprite 'simple' already exists" in out)
+        self.assertTrue("Format 'html'' for sprite 'simple' already exists" in out)
+        self.assertExists("output/simple@2x.png")
+        with open("output/simple.css") as f:
+            self.assertFalse("edited" in f.read())
+
+        # Outputs with other names are built even if the hash is the same.
+        code, out = self.call("glue simple output --css --html --json --retina "
+                              "--cachebuster-filename", capture=True)
+        self.assertEqual(code, 0)
+        self.assertTrue("Format 'img' for sprite 'simple' needs rebuild" in out)
+        with open("output/.glue-manifest") as f:
+            manifest = json.loads(f.read())
+        for name in manifest['entries']['img:simple']['outputs']:
+            self.assertExists(os.path.join("output", name))
+            self.assertTrue("_" in name)
+
+    def test_png_text(self):
+        self.create_image("simple/red.png", RED, size=(256, 256))
+        self.create_image("simple/blue.png", BLUE, size=(256, 256))
+        code = self.call("glue simple output")
+        self.assertEqual(code, 0)
+
+        with open("output/simple.png", "rb") as f:
+            text = png_text(f)
+            # The image data is never read.
+            self.assertTrue(f.tell() < os.path.getsize("output/simple.png") / 2)
+        self.assertEqual(text['Software'], 'glue-{0}'.format(__version__))
+        self.assertEqual(text['Comment'], PILImage.open("output/simple.png").info['Comment'])
+
+        with open("simple/red.png", "rb") as f:
+            self.assertEqual(png_text(f), {})
+        self.assertEqual(png_text(StringIO("GIF89a")), None)
+
+        # Without a manifest, the sprite image metadata is read without PIL.
+        os.remove("output/.glue-manifest")
+        with patch('glue.formats.img.PILImage.open') as mocked_open:
+            code, out = self.call("glue simple output", capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_open.called)
+        self.assertTrue("Format 'img'' for sprite 'simple' already exists" in out)
+
+    def test_lazy_sprites(self):
+        self.create_image("project/a/red.png", RED)
+        self.create_image("project/b/blue.png", BLUE)
+        self.create_image("project/c/green.png", GREEN)
+        code = self.call("glue project output --project --json")
+        self.assertEqual(code, 0)
+
+        # Up-to-date sprites are neither discovered nor processed.
+        with patch('glue.core.Image') as mocked_image:
+            code, out = self.call("glue project output --project --json", capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_image.called)
+        self.assertFalse("Processing" in out)
+        self.assertFalse("needs rebuild" in out)
+
+        self.create_image("project/b/blue.png", BLUE, size=(32, 32))
+        code, out = self.call("glue project output --project --json", capture=True)
+        self.assertEqual(code, 0)
+        self.assertFalse("Processing 'a'" in out)
+        self.assertTrue("Processing 'b'" in out)
+        self.assertFalse("Processing 'c'" in out)
+        self.assertEqual(PILImage.open("output/b.png").size, (32, 32))
+
+        # Settings changes are detected too.
+        with open("project/c/sprite.conf", "w") as f:
+            f.write("[sprite]\npadding=2\n")
+        code, out = self.call("glue project output --project --json", capture=True)
+        self.assertEqual(code, 0)
+        self.assertFalse("Processing 'a'" in out)
+        self.assertTrue("Processing 'c'" in out)
+        self.assertEqual(PILImage.open("output/c.png").size, (68, 68))
+
+    def test_project_jobs(self):
+        self.create_image("project/a/red.png", RED, size=(16, 16))
+        self.create_image("project/b/blue.png", BLUE, size=(64, 64))
+        self.create_image("project/b/green.png", GREEN, size=(64, 64))
+        self.create_image("project/c/yellow.png", YELLOW, size=(32, 32))
+
+        code, serial = self.call("glue project serial --project --json", capture=True)
+        self.assertEqual(code, 0)
+        code, parallel = self.call("glue project parallel --project --json --jobs=2",
+                                   capture=True)
+        self.assertEqual(code, 0)
+
+        # The log and the sprites are the same as building them one by one.
+        self.assertEqual(serial.replace("serial", "parallel"), parallel)
+        for name in ('a', 'b', 'c'):
+            self.assertEqual(PILImage.open("serial/{0}.png".format(name)).tobytes(),
+                             PILImage.open("parallel/{0}.png".format(name)).tobytes())
+            self.assertEqual(open("serial/{0}.json".format(name)).read(),
+                             open("parallel/{0}.json".format(name)).read())
+
+        # Unchanged sprites are fresh, so no worker is started at all.
+        with patch('glue.managers.base.multiprocessing.Process') as mocked_process:
+            code, out = self.call("glue project parallel --project --json --jobs=2",
+                                  capture=True)
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_process.called)
+        self.assertFalse("needs rebuild" in out)
+        self.assertFalse("Processing" in out)
+
+        # Sprites built one by one are fresh for parallel builds too.
+        with patch('glue.managers.base.multiprocessing.Process') as mocked_process:
+            code = self.call("glue project serial --project --json --jobs=2 --cache=cache")
+            self.assertEqual(code, 0)
+            self.assertFalse(mocked_process.called)
+
+        # The biggest sprites are started first.
+        started = []
+
+        class SyncProcess(object):
+            def __init__(self, target, args):
+                self.target = target
+                self.args = args
+                self.exitcode = None
+
+            def start(self):
+                started.append(os.path.basename(self.args[2][1]))
+                self.target(*self.args)
+                self.exitcode = 0
+
+            def terminate(self):
+                pass
+
+            def join(self):
+                pass
+
+        with patch('glue.managers.base.multiprocessing.Process', SyncProcess):
+            code = self.call("glue project sync --project --jobs=2 --max-memory=1")
+            self.assertEqual(code, 0)
+        self.assertEqual(started, ['b', 'c', 'a'])
+
+        # Workers reuse the list of images found by the parent.
+        with patch('glue.managers.base.multiprocessing.Process', SyncProcess):
+            with patch('glue.helpers._list_directory', wraps=_list_directory) as mocked_list:
+                code = self.call("glue project sync --project --jobs=2 --force")
+                self.assertEqual(code, 0)
+                self.assertEqual(mocked_list.call_count, 3)
+
+        # Unexpected errors are raised with the traceback of the worker.
+        with patch('glue.managers.base.multiprocessing.Process', SyncProcess):
+            with patch('glue.managers.base.BaseManager.save_sprite',
+                       side_effect=RuntimeError("worker failed")):
+                code = self.call("glue project sync --project --jobs=2 --force")
+                self.assertEqual(code, 1)
+        self.assertTrue("SpriteWorkerError: Traceback" in sys.stderr.getvalue())
+        self.assertTrue("RuntimeError: worker failed" in sys.stderr.getvalue())
+
+        # Workers killed without sending their result fail their sprite.
+        def kill(manager, sprite):
+            if sprite.name == 'b':
+                os.kill(os.getpid(), signal.SIGKILL)
+            return save_sprite(manager, sprite)
+
+        save_sprite = BaseManager.save_sprite.im_func
+        with patch.object(BaseManager, 'save_sprite', autospec=True, side_effect=kill):
+            code, out = self.call("glue project killed --project --jobs=2", capture=True)
+            self.assertEqual(code, 1)
+        self.assertTrue("SpriteWorkerError: The worker building sprite 'b' exited "
+                        "unexpectedly (exit code -9)." in sys.stderr.getvalue())
+        self.assertTrue("Processing 'a'" in out)
+        self.assertExists("killed/a.png")
+
+        # If several sprites fail, the error of the first one is raised.
+        self.create_image("project/a/red1.png", RED)
+        self.create_image("project/a/red 1.png", RED)
+        self.create_image("project/c/yellow1.png", YELLOW)
+        self.create_image("project/c/yellow 1.png", YELLOW)
+        code, out = self.call("glue project parallel --project --jobs=3", capture=True)
+        self.assertEqual(code, 3)
+        self.assertFalse("Processing 'c'" in out)
+
+        with self.assertRaises(SystemExit):
+            self.call("glue project output --project --jobs=2 --max-memory=0")
+
+    def test_pipeline(self):
+        consumed = []
+
+        def source():
+            for i in xrange(100):
+                consumed.append(i)
+                yield i
+
+        # Results keep the order of the items.
+        results = pipeline(lambda i: i * 2, source(), threads=4, buffer_size=8)
+        self.assertEqual(next(results), 0)
+        # Only a bounded number of items are consumed ahead.
+        self.assertTrue(len(consumed) <= 10)
+        self.assertEqual(list(results), range(2, 200, 2))
+
+        def fail(i):
+            if i == 5:
+                raise ValueError(i)
+            return i
+
+        results = pipeline(fail, xrange(10), threads=3)
+        self.assertEqual([next(results) for i in xrange(5)], range(5))
+        self.assertRaises(ValueError, next, results)
+
+        # Images are loaded and composed the same way using the pipeline.
+        for i, color in enumerate((RED, GREEN, BLUE, YELLOW, PINK, CYAN)):
+            self.create_image("simple/{0}.png".format(i), color, size=(16 + i, 16 + i), margin=2)
+        code = self.call("glue simple pipelined --crop")
+        self.assertEqual(code, 0)
+        with patch('glue.core.pipeline', lambda f, i, **kwargs: map(f, i)):
+            with patch('glue.formats.img.pipeline', lambda f, i, **kwargs: map(f, i)):
+                code = self.call("glue simple sequential --crop")
+                self.assertEqual(code, 0)
+        self.assertEqual(PILImage.open("pipelined/simple.png").tobytes(),
+                         PILImage.open("sequential/simple.png").tobytes())
+
+    def test_formats_are_built_concurrently(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+
+        css_started, json_started = threading.Event(), threading.Event()
+        waited = []
+
+        def build_css(format):
+            css_started.set()
+            waited.append(json_started.wait(5))
+            raise ValidationError("css failed\n")
+
+        def build_json(format):
+            json_started.set()
+            waited.append(css_started.wait(5))
+            raise ValidationError("json failed\n")
+
+        stderr = StringIO()
+        with patch('glue.formats.css.CssFormat.build', build_css):
+            with patch('glue.formats.jsonformat.JSONFormat.build', build_json):
+                with patch('sys.stderr', stderr):
+                    code = self.call("glue simple output --css --json")
+        self.assertEqual(code, 3)
+        # Both formats were being built at the same time.
+        self.assertEqual(waited, [True, True])
+
+        # The error of the first enabled format is always the one raised.
+        from glue.formats import formats
+        first = [f for f in formats if f in ('css', 'json')][0]
+        self.assertEqual(stderr.getvalue(), "{0} failed\n".format(first))
+        self.assertExists("output/simple.png")
+
+        code = self.call("glue simple output --css --json")
+        self.assertEqual(code, 0)
+        self.assertExists("output/simple.css")
+        self.assertExists("output/simple.json")
+
+    def test_ratios_are_built_once(self):
+        self.create_image("simple/red.png", RED)
+        self.create_image("simple/blue.png", BLUE)
+
+        resize, save = PILImage.Image.resize, PILImage.Image.save
+        with patch.object(PILImage.Image, 'resize', autospec=True, side_effect=resize) as mocked_resize:
+            with patch.object(PILImage.Image, 'save', autospec=True, side_effect=save) as mocked_save:
+                code = self.call("glue simple output --ratios=3,2,1.5,1")
+                self.assertEqual(code, 0)
+        # PIL resizes RGBA images calling resize again on a RGBa copy.
+        resized = [c[0][1] for c in mocked_resize.call_args_list if c[0][0].mode == 'RGBA']
+        self.assertEqual(sorted(resized), [(43, 22), (64, 32), (86, 43)])
+        self.assertEqual(sorted(os.path.basename(c[0][1]) for c in mocked_save.call_args_list),
+                         ['simple.png', 'simple@1.5x.png', 'simple@2x.png', 'simple@3x.png'])
+
+        self.assertEqual(PILImage.open("output/simple@3x.png").size, (128, 64))
+        self.assertEqual(PILImage.open("output/simple@2x.png").size, (86, 43))
+        self.assertEqual(PILImage.open("output/simple@1.5x.png").size, (64, 32))
+        self.assertEqual(PILImage.open("output/simple.png").size, (43, 22))
+
 if __name__ == '__main__':
     unittest.main()